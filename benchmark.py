@@ -0,0 +1,152 @@
+import argparse
+import json
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_services import FakeServices, get_fake_pizzerias, FAKE_TELEGRAM_TOKEN
+
+COURIER_CHAT_ID = 1
+FIRST_CUSTOMER_CHAT_ID = 1000000
+CUSTOMER_LOCATION = (37.6100, 55.7560)
+
+
+def get_percentile(values, percentile):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+
+def make_user(chat_id):
+    return {'id': chat_id, 'is_bot': False, 'first_name': f'Покупатель {chat_id}'}
+
+
+def make_message(chat_id, message_id=1, **fields):
+    return dict({
+        'message_id': message_id,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': make_user(chat_id),
+    }, **fields)
+
+
+def make_callback_update(chat_id, data, message_id):
+    return {
+        'update_id': 0,
+        'callback_query': {
+            'id': str(message_id),
+            'from': make_user(chat_id),
+            'chat_instance': str(chat_id),
+            'data': data,
+            'message': make_message(chat_id, message_id),
+        },
+    }
+
+
+def get_last_buttons(services, chat_id):
+    message = services.get_last_message(chat_id)
+    reply_markup = json.loads(message['reply_markup'])
+    return [button['callback_data'] for row in reply_markup['inline_keyboard'] for button in row]
+
+
+def run_journey(bot, services, chat_id, timings):
+    from telegram import Update
+    from tg_bot import handle_users_reply, process_successful_payment
+
+    def send(label, update_data, handler=handle_users_reply):
+        update = Update.de_json(update_data, bot)
+        started = time.perf_counter()
+        handler(bot, update)
+        timings[label].append(time.perf_counter() - started)
+
+    def last_message_id():
+        return services.get_last_message(chat_id)['message_id']
+
+    send('send_menu', {'update_id': 0, 'message': make_message(chat_id, text='/start')})
+    product_id = get_last_buttons(services, chat_id)[0]
+    send('handle_menu', make_callback_update(chat_id, product_id, last_message_id()))
+    send('handle_product_detail', make_callback_update(chat_id, product_id, last_message_id()))
+    send('handle_product_detail:menu', make_callback_update(chat_id, 'menu', last_message_id()))
+    send('handle_menu:cart', make_callback_update(chat_id, 'cart', last_message_id()))
+    send('handle_cart', make_callback_update(chat_id, 'checkout', last_message_id()))
+
+    longitude, latitude = CUSTOMER_LOCATION
+    send('handle_location_request', {'update_id': 0, 'message': make_message(
+        chat_id, location={'longitude': longitude, 'latitude': latitude})})
+    delivery_button = next(button for button in get_last_buttons(services, chat_id)
+                           if button.startswith('delivery'))
+    send('handle_delivery_options', make_callback_update(chat_id, delivery_button, last_message_id()))
+    send('handle_payment', make_callback_update(chat_id, 'payment', last_message_id()))
+
+    successful_payment = {
+        'currency': 'RUB',
+        'total_amount': 1,
+        'invoice_payload': 'Pizza_payment',
+        'telegram_payment_charge_id': str(chat_id),
+        'provider_payment_charge_id': str(chat_id),
+    }
+    send('process_successful_payment',
+         {'update_id': 0, 'message': make_message(chat_id, successful_payment=successful_payment)},
+         handler=process_successful_payment)
+
+
+def run_benchmark(services, journeys, concurrency):
+    from telegram import Bot
+
+    bot = Bot(FAKE_TELEGRAM_TOKEN, base_url=f'{os.environ["MOLTIN_ENDPOINT"]}/bot')
+    timings = defaultdict(list)
+    failures = []
+
+    def run(number):
+        try:
+            run_journey(bot, services, FIRST_CUSTOMER_CHAT_ID + number, timings)
+        except Exception as err:
+            failures.append(err)
+
+    calls_before = services.get_calls()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(run, range(journeys)))
+    elapsed = time.perf_counter() - started
+    calls = services.get_calls() - calls_before
+
+    return timings, calls, failures, elapsed
+
+
+def print_report(timings, calls, failures, elapsed, journeys):
+    print(f'journeys\t{journeys}\tfailed\t{len(failures)}\tseconds\t{elapsed:.2f}\t'
+          f'journeys/s\t{journeys / elapsed:.1f}')
+    print('\nhandler\tcount\tp50 ms\tp95 ms\tp99 ms')
+    for label, values in timings.items():
+        print(f'{label}\t{len(values)}\t' + '\t'.join(
+            f'{get_percentile(values, percentile) * 1000:.1f}' for percentile in (50, 95, 99)))
+    print('\nupstream call\tper journey')
+    for name, count in sorted(calls.items()):
+        print(f'{name}\t{count / journeys:.2f}')
+    for err in failures[:5]:
+        print(f'failure: {err!r}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест бота на локальных копиях Moltin и Telegram')
+    parser.add_argument('--journeys', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--products', type=int, default=30)
+    parser.add_argument('--moltin-latency', type=float, default=50, help='задержка ответа Moltin, мс')
+    parser.add_argument('--telegram-latency', type=float, default=30, help='задержка ответа Telegram, мс')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    services = FakeServices(args.products, get_fake_pizzerias(COURIER_CHAT_ID),
+                            args.moltin_latency / 1000, args.telegram_latency / 1000)
+    services.serve(port=args.port)
+    os.environ['MOLTIN_ENDPOINT'] = f'http://127.0.0.1:{args.port}'
+    os.environ.setdefault('TELEGRAM_PAYMENT_TOKEN', 'fake')
+    os.environ.setdefault('TELEGRAM_PAYMENT_PARAMETER', 'fake')
+
+    timings, calls, failures, elapsed = run_benchmark(services, args.journeys, args.concurrency)
+    print_report(timings, calls, failures, elapsed, args.journeys)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+import argparse
+import hashlib
+import json
+import logging
+
+from database import get_database_connection
+from moltin import fetch_products, get_flow_entries, update_product, delete_product, add_flow_entry, \
+    update_flow_entry, delete_flow_entry, invalidate_catalog_cache
+from pizza import get_menu_product, get_pizzeria_entry, import_pizza, forget_product_photo_file_id, RateLimiter, \
+    MENU_FILE, ADDRESSES_FILE, MENU_IMPORT_RATE, PIZZERIA_FLOW_SLUG
+
+IMAGE_SOURCES_KEY = 'catalog:image_sources'
+
+logger = logging.getLogger('pizza')
+
+
+def get_content_hash(content):
+    return hashlib.sha1(json.dumps(content, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+def get_product_content(product):
+    return {
+        'name': product['name'],
+        'description': product['description'],
+        'price': int(product['price']),
+    }
+
+
+def get_pizzeria_content(pizzeria):
+    return {
+        'address': pizzeria['address'],
+        'alias': pizzeria['alias'],
+        'longitude': round(float(pizzeria['longitude']), 6),
+        'latitude': round(float(pizzeria['latitude']), 6),
+    }
+
+
+def group_by_field(entries, field):
+    # copies left by blind reruns of the import share a sku/alias: the first one is kept, the rest are deleted
+    unique_entries, duplicate_ids = {}, []
+    for entry in entries:
+        if entry[field] in unique_entries:
+            duplicate_ids.append(entry['id'])
+        else:
+            unique_entries[entry[field]] = entry
+    return unique_entries, duplicate_ids
+
+
+def diff_menu(menu):
+    image_sources = {sku.decode(): url.decode()
+                     for sku, url in get_database_connection().hgetall(IMAGE_SOURCES_KEY).items()}
+    remote_products, duplicate_ids = group_by_field(fetch_products(), 'sku')
+
+    creates, updates, image_updates = [], [], []
+    for pizza in menu:
+        sku = str(pizza['id'])
+        remote_product = remote_products.pop(sku, None)
+        if remote_product is None:
+            creates.append(pizza)
+            continue
+
+        local_content = get_product_content(get_menu_product(pizza))
+        remote_content = get_product_content({
+            'name': remote_product['name'],
+            'description': remote_product['description'],
+            'price': remote_product['price'][0]['amount'],
+        })
+        if get_content_hash(local_content) != get_content_hash(remote_content):
+            updates.append((remote_product['id'], pizza))
+
+        main_image = remote_product.get('relationships', {}).get('main_image')
+        # an image without a recorded source is uploaded again once: its url may have changed before the first sync
+        if not main_image or image_sources.get(sku) != pizza['product_image']['url']:
+            previous_image_id = main_image['data']['id'] if main_image else None
+            image_updates.append((remote_product['id'], dict(pizza, previous_image_id=previous_image_id)))
+
+    deletes = duplicate_ids + [product['id'] for product in remote_products.values()]
+
+    return {'create': creates, 'update': updates, 'image': image_updates, 'delete': deletes}
+
+
+def diff_addresses(addresses):
+    remote_pizzerias, duplicate_ids = group_by_field(get_flow_entries(PIZZERIA_FLOW_SLUG), 'alias')
+
+    creates, updates = [], []
+    for address in addresses:
+        pizzeria = get_pizzeria_entry(address)
+        remote_pizzeria = remote_pizzerias.pop(pizzeria['alias'], None)
+        if remote_pizzeria is None:
+            creates.append(pizzeria)
+        elif get_content_hash(get_pizzeria_content(pizzeria)) != \
+                get_content_hash(get_pizzeria_content(remote_pizzeria)):
+            updates.append((remote_pizzeria['id'], pizzeria))
+
+    deletes = duplicate_ids + [pizzeria['id'] for pizzeria in remote_pizzerias.values()]
+
+    return {'create': creates, 'update': updates, 'delete': deletes}
+
+
+def apply_menu_diff(diff):
+    db = get_database_connection()
+    rate_limiter = RateLimiter(MENU_IMPORT_RATE)
+
+    for pizza in diff['create']:
+        import_pizza(pizza, {}, rate_limiter)
+        db.hset(IMAGE_SOURCES_KEY, str(pizza['id']), pizza['product_image']['url'])
+    for product_id, pizza in diff['update']:
+        rate_limiter.wait()
+        update_product(product_id, get_menu_product(pizza))
+    for product_id, pizza in diff['image']:
+        import_pizza(pizza, {'product_id': product_id}, rate_limiter)
+        if pizza['previous_image_id']:
+            forget_product_photo_file_id(pizza['previous_image_id'])
+        db.hset(IMAGE_SOURCES_KEY, str(pizza['id']), pizza['product_image']['url'])
+    for product_id in diff['delete']:
+        rate_limiter.wait()
+        delete_product(product_id)
+
+
+def apply_addresses_diff(diff):
+    for pizzeria in diff['create']:
+        add_flow_entry(PIZZERIA_FLOW_SLUG, pizzeria)
+    for entry_id, pizzeria in diff['update']:
+        update_flow_entry(PIZZERIA_FLOW_SLUG, entry_id, pizzeria)
+    for entry_id in diff['delete']:
+        delete_flow_entry(PIZZERIA_FLOW_SLUG, entry_id)
+
+
+def describe_diff_item(item):
+    if isinstance(item, tuple):
+        entry_id, item = item
+        return f'{entry_id} {describe_diff_item(item)}'
+    if isinstance(item, dict):
+        return item.get('name') or item.get('alias')
+    return item
+
+
+def format_diff_report(name, diff):
+    rows = [f'{name}: ' + ', '.join(f'{operation} {len(items)}' for operation, items in diff.items())]
+    for operation, items in diff.items():
+        for item in items:
+            rows.append(f'  {operation} {describe_diff_item(item)}')
+    return '\n'.join(rows)
+
+
+def is_diff_empty(diff):
+    return not any(diff.values())
+
+
+def sync_menu(menu_file, dry_run=False):
+    with open(menu_file, 'r') as file:
+        menu = json.load(file)
+
+    diff = diff_menu(menu)
+    if not dry_run and not is_diff_empty(diff):
+        apply_menu_diff(diff)
+        invalidate_catalog_cache()
+    return diff
+
+
+def sync_addresses(addresses_file, dry_run=False):
+    with open(addresses_file, 'r') as file:
+        addresses = json.load(file)
+
+    diff = diff_addresses(addresses)
+    if not dry_run and not is_diff_empty(diff):
+        apply_addresses_diff(diff)
+        invalidate_catalog_cache()
+    return diff
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Синхронизация меню и пиццерий с Moltin')
+    parser.add_argument('catalog', choices=['menu', 'addresses'])
+    parser.add_argument('--dry-run', action='store_true', help='только показать изменения')
+    args = parser.parse_args()
+
+    if args.catalog == 'menu':
+        diff = sync_menu(MENU_FILE, args.dry_run)
+    else:
+        diff = sync_addresses(ADDRESSES_FILE, args.dry_run)
+
+    print(format_diff_report(args.catalog, diff))
+
+
+if __name__ == '__main__':
+    main()
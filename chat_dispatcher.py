@@ -0,0 +1,68 @@
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger('tg_bot')
+
+
+class ChatDispatcher:
+    # Updates are routed to a worker by chat id, so one chat is always handled by the same thread
+    # in arrival order while different chats run in parallel. Full queues block the producer.
+    def __init__(self, workers, queue_size, put_timeout=None):
+        self.put_timeout = put_timeout
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.stats_lock = threading.Lock()
+        self.stats = {'submitted': 0, 'processed': 0, 'failed': 0, 'rejected': 0, 'blocked_seconds': 0.0}
+        self.threads = [
+            threading.Thread(target=self._work, args=(worker_queue,), name=f'chat-worker-{number}', daemon=True)
+            for number, worker_queue in enumerate(self.queues)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def _count(self, name, value=1):
+        with self.stats_lock:
+            self.stats[name] += value
+
+    def _work(self, worker_queue):
+        while True:
+            task = worker_queue.get()
+            if task is None:
+                break
+            callback, args = task
+            try:
+                callback(*args)
+                self._count('processed')
+            except Exception as err:
+                self._count('failed')
+                logger.error(err)
+            finally:
+                worker_queue.task_done()
+
+    def submit(self, chat_id, callback, *args):
+        worker_queue = self.queues[hash(chat_id) % len(self.queues)]
+        started = time.monotonic()
+        try:
+            worker_queue.put((callback, args), timeout=self.put_timeout)
+        except queue.Full:
+            self._count('rejected')
+            logger.warning(f'Update for chat {chat_id} rejected, worker queue is full')
+            return False
+        self._count('blocked_seconds', time.monotonic() - started)
+        self._count('submitted')
+        return True
+
+    def get_stats(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        depths = [worker_queue.qsize() for worker_queue in self.queues]
+        stats['queue_depth'] = sum(depths)
+        stats['max_queue_depth'] = max(depths)
+        return stats
+
+    def stop(self):
+        for worker_queue in self.queues:
+            worker_queue.put(None)
+        for thread in self.threads:
+            thread.join()
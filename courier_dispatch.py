@@ -0,0 +1,142 @@
+import os
+import logging
+import socket
+from collections import defaultdict
+
+import redis
+from dotenv import load_dotenv
+from telegram import Bot
+from telegram.utils.request import Request
+
+from database import get_database_connection
+from metrics import timed, increment
+from pizza import get_customer_location, get_nearest_pizzeria, get_pizzeria
+
+load_dotenv()
+TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
+TELEGRAM_PROXY = os.getenv('TELEGRAM_PROXY')
+
+COURIER_ORDERS_STREAM = 'courier:orders'
+COURIER_DEAD_ORDERS_STREAM = 'courier:orders:dead'
+COURIER_GROUP = 'couriers'
+COURIER_BATCH_SIZE = int(os.getenv('COURIER_BATCH_SIZE', 50))
+COURIER_BLOCK_MS = 1000
+COURIER_MAX_ATTEMPTS = int(os.getenv('COURIER_MAX_ATTEMPTS', 8))
+COURIER_RETRY_BACKOFF_MS = 2000
+COURIER_RETRY_BACKOFF_MAX_MS = 5 * 60 * 1000
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+logger = logging.getLogger('tg_bot')
+
+
+def enqueue_courier_order(customer_id, cart_text, context):
+    order = {'customer_id': customer_id, 'cart_text': cart_text}
+    for field in ('pizzeria_id', 'longitude', 'latitude'):
+        if field in context:
+            order[field] = context[field]
+    return get_database_connection().xadd(COURIER_ORDERS_STREAM, order)
+
+
+def ensure_consumer_group(db):
+    try:
+        db.xgroup_create(COURIER_ORDERS_STREAM, COURIER_GROUP, id='0', mkstream=True)
+    except redis.exceptions.ResponseError as err:
+        if 'BUSYGROUP' not in str(err):
+            raise
+
+
+def get_retry_backoff_ms(times_delivered):
+    return min(COURIER_RETRY_BACKOFF_MS * 2 ** (times_delivered - 1), COURIER_RETRY_BACKOFF_MAX_MS)
+
+
+def claim_retries(db, consumer):
+    pending = db.xpending_range(COURIER_ORDERS_STREAM, COURIER_GROUP, '-', '+', COURIER_BATCH_SIZE)
+    retry_ids = []
+    for entry in pending:
+        if entry['times_delivered'] >= COURIER_MAX_ATTEMPTS:
+            for message_id, order in db.xrange(COURIER_ORDERS_STREAM, entry['message_id'], entry['message_id']):
+                db.xadd(COURIER_DEAD_ORDERS_STREAM, order)
+            db.xack(COURIER_ORDERS_STREAM, COURIER_GROUP, entry['message_id'])
+            increment('courier_orders_dead_total')
+            logger.error(f'Courier order {entry["message_id"]} moved to {COURIER_DEAD_ORDERS_STREAM}')
+        elif entry['time_since_delivered'] >= get_retry_backoff_ms(entry['times_delivered']):
+            retry_ids.append(entry['message_id'])
+
+    if not retry_ids:
+        return []
+    return db.xclaim(COURIER_ORDERS_STREAM, COURIER_GROUP, consumer, 0, retry_ids)
+
+
+def read_orders(db, consumer):
+    orders = claim_retries(db, consumer)
+    streams = db.xreadgroup(COURIER_GROUP, consumer, {COURIER_ORDERS_STREAM: '>'}, count=COURIER_BATCH_SIZE,
+                            block=COURIER_BLOCK_MS)
+    for _, messages in streams:
+        orders.extend(messages)
+    return [(message_id, {field.decode(): value.decode() for field, value in order.items()})
+            for message_id, order in orders if order]
+
+
+def resolve_order(order):
+    if 'pizzeria_id' in order and 'longitude' in order:
+        order['location'] = (order['longitude'], order['latitude'])
+    else:
+        order['location'] = get_customer_location(order['customer_id'])
+        order['pizzeria_id'], _ = get_nearest_pizzeria(order['location'])
+    return order
+
+
+def split_courier_text(text):
+    return [text[start:start + TELEGRAM_MESSAGE_LIMIT] for start in range(0, len(text), TELEGRAM_MESSAGE_LIMIT)]
+
+
+def send_order_to_courier(bot, courier_id, order):
+    courier_text = f'Заказ {order["customer_id"]}\n\n{order["cart_text"]}\n\nЗАКАЗ ОПЛАЧЕН'
+    for courier_text_part in split_courier_text(courier_text):
+        bot.send_message(chat_id=courier_id, text=courier_text_part)
+    longitude, latitude = order['location']
+    bot.send_location(chat_id=courier_id, latitude=latitude, longitude=longitude)
+
+
+def dispatch_batch(bot, db, orders):
+    orders_by_pizzeria = defaultdict(list)
+    for message_id, order in orders:
+        try:
+            order = resolve_order(order)
+        except Exception as err:
+            logger.error(f'Courier order {message_id} not resolved: {err}')
+            continue
+        orders_by_pizzeria[order['pizzeria_id']].append((message_id, order))
+
+    for pizzeria_id, pizzeria_orders in orders_by_pizzeria.items():
+        try:
+            courier_id = get_pizzeria(pizzeria_id)['courier-id']
+            for message_id, order in pizzeria_orders:
+                with timed('courier_dispatch'):
+                    send_order_to_courier(bot, courier_id, order)
+                # acked one by one, so a retry only resends the orders the courier has not got yet
+                db.xack(COURIER_ORDERS_STREAM, COURIER_GROUP, message_id)
+                increment('courier_orders_sent_total')
+        except Exception as err:
+            increment('courier_dispatch_failures_total')
+            logger.error(f'Orders for pizzeria {pizzeria_id} not sent, will retry: {err}')
+
+
+def run_courier_dispatcher(bot, consumer=None):
+    consumer = consumer or f'{socket.gethostname()}-{os.getpid()}'
+    db = get_database_connection()
+    ensure_consumer_group(db)
+    logger.info(f'Courier dispatcher {consumer} started')
+    while True:
+        orders = read_orders(db, consumer)
+        if orders:
+            dispatch_batch(bot, db, orders)
+
+
+def main():
+    bot = Bot(TELEGRAM_TOKEN, request=Request(proxy_url=TELEGRAM_PROXY))
+    run_courier_dispatcher(bot)
+
+
+if __name__ == '__main__':
+    main()
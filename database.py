@@ -0,0 +1,105 @@
+import os
+import json
+import time
+import logging
+import uuid
+
+import redis
+from dotenv import load_dotenv
+
+from metrics import timed
+
+load_dotenv()
+REDIS_HOST = os.getenv('REDIS_HOST')
+REDIS_PORT = os.getenv('REDIS_PORT')
+REDIS_PASWORD = os.getenv('REDIS_PASWORD')
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 50))
+
+SHARED_CACHE_TTL = int(os.getenv('SHARED_CACHE_TTL', 3600))
+CATALOG_VERSION_CHECK_INTERVAL = int(os.getenv('CATALOG_VERSION_CHECK_INTERVAL', 5))
+CATALOG_VERSION_KEY = 'catalog:version'
+CATALOG_LOCK_TIMEOUT = 30
+CATALOG_LOCK_WAIT = 0.05
+
+_database = None
+_catalog_version = None
+_catalog_version_checked = 0
+
+logger = logging.getLogger('redis')
+
+
+class InstrumentedRedis(redis.Redis):
+    def execute_command(self, *args, **options):
+        with timed('redis_command', command=args[0]):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error=True):
+        with timed('redis_command', command='PIPELINE'):
+            return super().execute(raise_on_error)
+
+
+def get_database_connection():
+    global _database
+    if _database is None:
+        database_password = REDIS_PASWORD
+        database_host = REDIS_HOST
+        database_port = REDIS_PORT
+        pool = redis.BlockingConnectionPool(host=database_host, port=database_port, password=database_password,
+                                            max_connections=REDIS_MAX_CONNECTIONS)
+        _database = InstrumentedRedis(connection_pool=pool)
+    return _database
+
+
+def get_catalog_version():
+    global _catalog_version, _catalog_version_checked
+    now = time.monotonic()
+    if _catalog_version is None or now - _catalog_version_checked >= CATALOG_VERSION_CHECK_INTERVAL:
+        version = get_database_connection().get(CATALOG_VERSION_KEY)
+        _catalog_version = int(version) if version else 0
+        _catalog_version_checked = now
+    return _catalog_version
+
+
+def bump_catalog_version():
+    global _catalog_version, _catalog_version_checked
+    _catalog_version = get_database_connection().incr(CATALOG_VERSION_KEY)
+    _catalog_version_checked = time.monotonic()
+    logger.info(f'Catalog version bumped to {_catalog_version}')
+    return _catalog_version
+
+
+def get_shared_cached(key, loader, version=None):
+    db = get_database_connection()
+    if version is None:
+        version = get_catalog_version()
+    cache_key = f'catalog:{version}:{key}'
+    lock_key = f'{cache_key}:lock'
+
+    cached = db.get(cache_key)
+    if cached is not None:
+        return json.loads(cached)
+
+    lock_token = str(uuid.uuid4())
+    deadline = time.monotonic() + CATALOG_LOCK_TIMEOUT
+    while not db.set(lock_key, lock_token, nx=True, ex=CATALOG_LOCK_TIMEOUT):
+        time.sleep(CATALOG_LOCK_WAIT)
+        cached = db.get(cache_key)
+        if cached is not None:
+            return json.loads(cached)
+        if time.monotonic() >= deadline:
+            logger.warning(f'Gave up waiting for {lock_key}, loading without lock')
+            return loader()
+
+    try:
+        value = loader()
+        db.set(cache_key, json.dumps(value), ex=SHARED_CACHE_TTL)
+    finally:
+        if db.get(lock_key) == lock_token.encode():
+            db.delete(lock_key)
+
+    return value
@@ -0,0 +1,106 @@
+import logging
+
+import numpy as np
+from geopy.distance import distance
+
+from moltin import get_flow_entries
+from pizza import get_pizzerias, DELIVERY_OPTIONS, CUSTOMER_LOCATION_FLOW_SLUG
+
+# Distances use Lambert's formula on the WGS-84 ellipsoid. Against geopy's geodesic distance
+# the error stays below 10 metres for anything within the delivery range, so rows that close
+# to a tier boundary are recomputed with geopy to price them exactly like the bot does.
+WGS84_A_KM = 6378.137
+WGS84_F = 1 / 298.257223563
+DISTANCE_TOLERANCE_KM = 0.01
+
+NEAREST_PIZZERIA_CANDIDATES = 3
+BATCH_CHUNK_SIZE = 4096
+NO_DELIVERY_PRICE = -1
+
+logger = logging.getLogger('pizza')
+
+
+def to_unit_vectors(latitudes, longitudes):
+    latitudes, longitudes = np.radians(latitudes), np.radians(longitudes)
+    cos_latitudes = np.cos(latitudes)
+    return np.stack([cos_latitudes * np.cos(longitudes), cos_latitudes * np.sin(longitudes), np.sin(latitudes)],
+                    axis=-1)
+
+
+def lambert_distance_km(latitudes1, longitudes1, latitudes2, longitudes2):
+    beta1 = np.arctan((1 - WGS84_F) * np.tan(np.radians(latitudes1)))
+    beta2 = np.arctan((1 - WGS84_F) * np.tan(np.radians(latitudes2)))
+    delta_longitudes = np.radians(longitudes2 - longitudes1)
+
+    haversine = np.sin((beta2 - beta1) / 2) ** 2 + np.cos(beta1) * np.cos(beta2) * np.sin(delta_longitudes / 2) ** 2
+    sigma = 2 * np.arcsin(np.sqrt(np.clip(haversine, 0, 1)))
+
+    p = (beta1 + beta2) / 2
+    q = (beta2 - beta1) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = (sigma - np.sin(sigma)) * np.sin(p) ** 2 * np.cos(q) ** 2 / np.cos(sigma / 2) ** 2
+        y = (sigma + np.sin(sigma)) * np.cos(p) ** 2 * np.sin(q) ** 2 / np.sin(sigma / 2) ** 2
+    correction = np.where(sigma > 0, x + y, 0)
+
+    return WGS84_A_KM * (sigma - WGS84_F / 2 * correction)
+
+
+def get_delivery_prices(distances):
+    limits = np.array(list(DELIVERY_OPTIONS.keys()))
+    prices = np.array(list(DELIVERY_OPTIONS.values()) + [NO_DELIVERY_PRICE])
+    return prices[np.searchsorted(limits, distances, side='left')]
+
+
+def quote_deliveries(longitudes, latitudes, pizzerias=None):
+    if pizzerias is None:
+        pizzerias = get_pizzerias()
+    longitudes = np.asarray(longitudes, dtype=float)
+    latitudes = np.asarray(latitudes, dtype=float)
+
+    pizzeria_ids = np.array([pizzeria['id'] for pizzeria in pizzerias])
+    pizzeria_latitudes = np.array([float(pizzeria['latitude']) for pizzeria in pizzerias])
+    pizzeria_longitudes = np.array([float(pizzeria['longitude']) for pizzeria in pizzerias])
+    pizzeria_vectors = to_unit_vectors(pizzeria_latitudes, pizzeria_longitudes)
+    candidates_count = min(NEAREST_PIZZERIA_CANDIDATES, len(pizzerias))
+
+    nearest = np.empty(len(longitudes), dtype=int)
+    distances = np.empty(len(longitudes))
+    for start in range(0, len(longitudes), BATCH_CHUNK_SIZE):
+        chunk = slice(start, start + BATCH_CHUNK_SIZE)
+        similarity = to_unit_vectors(latitudes[chunk], longitudes[chunk]) @ pizzeria_vectors.T
+        candidates = np.argpartition(-similarity, candidates_count - 1, axis=1)[:, :candidates_count]
+
+        candidate_distances = lambert_distance_km(
+            latitudes[chunk, None], longitudes[chunk, None],
+            pizzeria_latitudes[candidates], pizzeria_longitudes[candidates],
+        )
+        best = np.argmin(candidate_distances, axis=1)
+        rows = np.arange(len(best))
+        nearest[chunk] = candidates[rows, best]
+        distances[chunk] = np.round(candidate_distances[rows, best], 3)
+
+    limits = np.array(list(DELIVERY_OPTIONS.keys()))
+    near_limit = np.abs(distances[:, None] - limits).min(axis=1) <= DISTANCE_TOLERANCE_KM
+    for row in np.flatnonzero(near_limit):
+        geodesic_distances = [distance((latitude, longitude), (latitudes[row], longitudes[row])).km
+                              for latitude, longitude in zip(pizzeria_latitudes, pizzeria_longitudes)]
+        nearest[row] = np.argmin(geodesic_distances)
+        distances[row] = round(geodesic_distances[nearest[row]], 3)
+
+    return pizzeria_ids[nearest], distances, get_delivery_prices(distances)
+
+
+def main():
+    longitudes, latitudes = [], []
+    for location in get_flow_entries(CUSTOMER_LOCATION_FLOW_SLUG, stream=True):
+        longitudes.append(location['longitude'])
+        latitudes.append(location['latitude'])
+    _, _, prices = quote_deliveries(longitudes, latitudes)
+
+    tiers, counts = np.unique(prices, return_counts=True)
+    for tier, count in zip(tiers, counts):
+        print(f'{tier}\t{count}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+import argparse
+import json
+import logging
+import math
+from datetime import datetime
+
+import numpy as np
+
+from delivery_pricing import quote_deliveries, NO_DELIVERY_PRICE
+from pizza import get_pizzerias, get_pizzerias_hash, DELIVERY_OPTIONS, DELIVERY_ZONES_FILE
+from spatial import geohash_encode, geohash_cell_size
+
+DELIVERY_ZONES_PRECISION = 7
+KM_PER_LATITUDE_DEGREE = 111.2
+CELL_CORNER_INSET = 0.999
+
+logger = logging.getLogger('pizza')
+
+
+def get_service_area(pizzerias, radius_km):
+    latitudes = [float(pizzeria['latitude']) for pizzeria in pizzerias]
+    longitudes = [float(pizzeria['longitude']) for pizzeria in pizzerias]
+    latitude_margin = radius_km / KM_PER_LATITUDE_DEGREE
+    longitude_margin = radius_km / (KM_PER_LATITUDE_DEGREE * math.cos(math.radians(max(map(abs, latitudes)))))
+    return (min(latitudes) - latitude_margin, max(latitudes) + latitude_margin,
+            min(longitudes) - longitude_margin, max(longitudes) + longitude_margin)
+
+
+def build_delivery_zones(pizzerias, precision=DELIVERY_ZONES_PRECISION):
+    cell_height, cell_width = geohash_cell_size(precision)
+    min_latitude, max_latitude, min_longitude, max_longitude = get_service_area(pizzerias, max(DELIVERY_OPTIONS))
+
+    latitudes = np.arange(math.floor(min_latitude / cell_height), math.ceil(max_latitude / cell_height))
+    longitudes = np.arange(math.floor(min_longitude / cell_width), math.ceil(max_longitude / cell_width))
+    center_latitudes, center_longitudes = np.meshgrid((latitudes + 0.5) * cell_height,
+                                                      (longitudes + 0.5) * cell_width, indexing='ij')
+    center_latitudes, center_longitudes = center_latitudes.ravel(), center_longitudes.ravel()
+
+    half_height, half_width = cell_height / 2 * CELL_CORNER_INSET, cell_width / 2 * CELL_CORNER_INSET
+    points = [(0, 0), (-half_height, -half_width), (-half_height, half_width),
+              (half_height, -half_width), (half_height, half_width)]
+    quotes = [quote_deliveries(center_longitudes + longitude_shift, center_latitudes + latitude_shift, pizzerias)
+              for latitude_shift, longitude_shift in points]
+
+    pizzeria_ids = np.stack([pizzeria_ids for pizzeria_ids, _, _ in quotes])
+    prices = np.stack([prices for _, _, prices in quotes])
+    is_uniform = (pizzeria_ids == pizzeria_ids[0]).all(axis=0) & (prices == prices[0]).all(axis=0)
+    is_served = prices[0] != NO_DELIVERY_PRICE
+
+    pizzeria_numbers = {pizzeria['id']: number for number, pizzeria in enumerate(pizzerias)}
+    cells = {}
+    for cell in np.flatnonzero(is_uniform & is_served):
+        geohash = geohash_encode(center_latitudes[cell], center_longitudes[cell], precision)
+        cells[geohash] = [pizzeria_numbers[pizzeria_ids[0][cell]], int(prices[0][cell])]
+
+    logger.info(f'{len(cells)} of {len(center_latitudes)} cells mapped, '
+                f'{int((~is_uniform & is_served).sum())} boundary cells left for exact calculation')
+
+    return {
+        'precision': precision,
+        'built_at': datetime.utcnow().isoformat(),
+        'pizzerias_hash': get_pizzerias_hash(pizzerias),
+        'delivery_options': [[limit, price] for limit, price in DELIVERY_OPTIONS.items()],
+        'pizzerias': [pizzeria['id'] for pizzeria in pizzerias],
+        'cells': cells,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Строит карту зон доставки по пиццериям из Moltin')
+    parser.add_argument('--precision', type=int, default=DELIVERY_ZONES_PRECISION, help='длина geohash ячейки')
+    parser.add_argument('--output', default=DELIVERY_ZONES_FILE)
+    args = parser.parse_args()
+
+    zones = build_delivery_zones(get_pizzerias(), args.precision)
+    with open(args.output, 'w') as file:
+        json.dump(zones, file, sort_keys=True, indent=0)
+
+
+if __name__ == '__main__':
+    main()
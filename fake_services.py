@@ -0,0 +1,235 @@
+import json
+import re
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+FAKE_TELEGRAM_TOKEN = '123456:fake'
+MOLTIN_ROUTES = [
+    ('POST', r'/oauth/access_token', 'oauth'),
+    ('GET', r'/v2/products', 'get_products'),
+    ('GET', r'/v2/products/(?P<product_id>[^/]+)', 'get_product'),
+    ('GET', r'/v2/files/(?P<file_id>[^/]+)', 'get_file'),
+    ('GET', r'/v2/carts/:(?P<cart_id>[^/]+)/items', 'get_cart'),
+    ('POST', r'/v2/carts/:(?P<cart_id>[^/]+)/items', 'add_cart_item'),
+    ('DELETE', r'/v2/carts/:(?P<cart_id>[^/]+)/items/(?P<item_id>[^/]+)', 'remove_cart_item'),
+    ('DELETE', r'/v2/carts/:(?P<cart_id>[^/]+)', 'delete_cart'),
+    ('GET', r'/v2/flows/(?P<flow_slug>[^/]+)/entries', 'get_flow_entries'),
+    ('POST', r'/v2/flows/(?P<flow_slug>[^/]+)/entries', 'add_flow_entry'),
+    ('GET', r'/v2/flows/(?P<flow_slug>[^/]+)/entries/(?P<entry_id>[^/]+)', 'get_flow_entry'),
+]
+TELEGRAM_BOOLEAN_METHODS = ('answerCallbackQuery', 'deleteMessage', 'answerPreCheckoutQuery', 'setWebhook')
+
+
+def format_price(amount):
+    return f'{amount} руб.'
+
+
+class FakeServices:
+    # In-memory stand-in for api.moltin.com and api.telegram.org served from one local HTTP server.
+    def __init__(self, products_count=30, pizzerias=(), moltin_latency=0, telegram_latency=0):
+        self.moltin_latency = moltin_latency
+        self.telegram_latency = telegram_latency
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.message_id = 0
+        self.last_messages = {}
+        self.carts = defaultdict(list)
+        self.files = {}
+        self.products = {}
+        self.flows = defaultdict(dict)
+
+        for number in range(products_count):
+            file_id = str(uuid.uuid4())
+            self.files[file_id] = f'https://example.com/pizza/{number}.jpg'
+            product_id = str(uuid.uuid4())
+            self.products[product_id] = {
+                'id': product_id,
+                'name': f'Пицца {number}',
+                'sku': str(number),
+                'description': f'Описание пиццы {number}',
+                'price': [{'amount': 300 + number * 10, 'currency': 'RUR', 'includes_tax': True}],
+                'meta': {'display_price': {'with_tax': {'formatted': format_price(300 + number * 10)}}},
+                'relationships': {'main_image': {'data': {'type': 'main_image', 'id': file_id}}},
+            }
+        for pizzeria in pizzerias:
+            self.add_flow_entry('pizzeria', pizzeria)
+
+    def add_flow_entry(self, flow_slug, entry):
+        entry_id = str(uuid.uuid4())
+        self.flows[flow_slug][entry_id] = dict(entry, id=entry_id, type='entry', meta={
+            'timestamps': {'created_at': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())},
+        })
+        return self.flows[flow_slug][entry_id]
+
+    def get_cart_response(self, cart_id):
+        items = self.carts[cart_id]
+        total = sum(item['unit_price']['amount'] * item['quantity'] for item in items)
+        return {
+            'data': items,
+            'meta': {'display_price': {'with_tax': {'amount': total, 'formatted': format_price(total)}}},
+        }
+
+    def make_cart_item(self, item):
+        if item['type'] == 'cart_item':
+            product = self.products[item['id']]
+            name, sku, description = product['name'], product['sku'], product['description']
+            amount, product_id = product['price'][0]['amount'], product['id']
+        else:
+            name, sku, description = item['name'], item['sku'], None
+            amount, product_id = item['price']['amount'], None
+        quantity = item.get('quantity', 1)
+        cart_item = {
+            'id': str(uuid.uuid4()),
+            'type': item['type'],
+            'name': name,
+            'sku': sku,
+            'description': description,
+            'quantity': quantity,
+            'unit_price': {'amount': amount},
+            'meta': {'display_price': {'with_tax': {
+                'unit': {'formatted': format_price(amount)},
+                'value': {'formatted': format_price(amount * quantity)},
+            }}},
+        }
+        if product_id:
+            cart_item['product_id'] = product_id
+        return cart_item
+
+    def handle_moltin(self, method, path, query, body):
+        for route_method, pattern, name in MOLTIN_ROUTES:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                break
+        else:
+            return 404, {'errors': [{'title': 'Not found'}]}
+
+        params = match.groupdict()
+        with self.lock:
+            self.calls[f'moltin.{name}'] += 1
+            if name == 'oauth':
+                return 200, {'token_type': 'Bearer', 'access_token': str(uuid.uuid4()),
+                             'expires': int(time.time()) + 3600}
+            if name == 'get_products':
+                return 200, self.paginate(list(self.products.values()), query)
+            if name == 'get_product':
+                return 200, {'data': self.products[params['product_id']]}
+            if name == 'get_file':
+                return 200, {'data': {'id': params['file_id'], 'link': {'href': self.files[params['file_id']]}}}
+            if name == 'get_cart':
+                return 200, self.get_cart_response(params['cart_id'])
+            if name == 'add_cart_item':
+                self.carts[params['cart_id']].append(self.make_cart_item(body['data']))
+                return 201, self.get_cart_response(params['cart_id'])
+            if name == 'remove_cart_item':
+                self.carts[params['cart_id']] = [item for item in self.carts[params['cart_id']]
+                                                 if item['id'] != params['item_id']]
+                return 200, self.get_cart_response(params['cart_id'])
+            if name == 'delete_cart':
+                self.carts.pop(params['cart_id'], None)
+                return 204, None
+            if name == 'get_flow_entries':
+                return 200, self.paginate(list(self.flows[params['flow_slug']].values()), query)
+            if name == 'add_flow_entry':
+                entry = {field: value for field, value in body['data'].items() if field != 'type'}
+                return 201, {'data': self.add_flow_entry(params['flow_slug'], entry)}
+            if name == 'get_flow_entry':
+                return 200, {'data': self.flows[params['flow_slug']][params['entry_id']]}
+
+    def paginate(self, entries, query):
+        limit = int(query.get('page[limit]', [100])[0])
+        offset = int(query.get('page[offset]', [0])[0])
+        has_next = offset + limit < len(entries)
+        return {
+            'data': entries[offset:offset + limit],
+            'links': {'next': f'?page[offset]={offset + limit}' if has_next else None},
+        }
+
+    def handle_telegram(self, method_name, body):
+        with self.lock:
+            self.calls[f'telegram.{method_name}'] += 1
+        if method_name in TELEGRAM_BOOLEAN_METHODS:
+            return 200, {'ok': True, 'result': True}
+
+        chat_id = int(body.get('chat_id', 0))
+        with self.lock:
+            self.message_id += 1
+            message = {
+                'message_id': self.message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': body.get('text') or body.get('caption'),
+            }
+            self.last_messages[chat_id] = dict(body, message_id=self.message_id)
+        return 200, {'ok': True, 'result': message}
+
+    def get_last_message(self, chat_id):
+        with self.lock:
+            return self.last_messages.get(chat_id)
+
+    def get_calls(self):
+        with self.lock:
+            return Counter(self.calls)
+
+    def make_handler(self):
+        services = self
+
+        class FakeServicesHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def handle_request(self, method):
+                url = urlparse(self.path)
+                raw_body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                body = {}
+                if raw_body and self.headers.get('Content-Type', '').startswith('application/json'):
+                    body = json.loads(raw_body)
+                elif raw_body:
+                    body = {field: values[0] for field, values in parse_qs(raw_body.decode()).items()}
+
+                if url.path.startswith('/bot'):
+                    time.sleep(services.telegram_latency)
+                    status, response = services.handle_telegram(url.path.rsplit('/', 1)[-1], body)
+                else:
+                    time.sleep(services.moltin_latency)
+                    status, response = services.handle_moltin(method, url.path, parse_qs(url.query), body)
+
+                payload = json.dumps(response).encode() if response is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self.handle_request('GET')
+
+            def do_POST(self):
+                self.handle_request('POST')
+
+            def do_DELETE(self):
+                self.handle_request('DELETE')
+
+            def log_message(self, format, *args):
+                pass
+
+        return FakeServicesHandler
+
+    def serve(self, host='127.0.0.1', port=0):
+        server = ThreadingHTTPServer((host, port), self.make_handler())
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='fake-services', daemon=True).start()
+        return server
+
+
+def get_fake_pizzerias(courier_id):
+    return [
+        {'address': 'Москва, улица Тверская, 7', 'alias': 'tverskaya', 'latitude': 55.7575, 'longitude': 37.6131,
+         'courier-id': courier_id},
+        {'address': 'Москва, Ленинский проспект, 30', 'alias': 'leninsky', 'latitude': 55.7073, 'longitude': 37.5848,
+         'courier-id': courier_id},
+        {'address': 'Москва, улица Арбат, 20', 'alias': 'arbat', 'latitude': 55.7515, 'longitude': 37.5923,
+         'courier-id': courier_id},
+    ]
@@ -1,8 +1,10 @@
 import os
+import sys
 import logging.config
 
 from dotenv import load_dotenv
 
+from courier_dispatch import main as start_courier_dispatcher
 from tg_bot import start_bot
 
 load_dotenv()
@@ -49,4 +51,7 @@ log_config = {
 logging.config.dictConfig(log_config)
 
 if __name__ == '__main__':
-    start_bot()
+    if sys.argv[1:] == ['courier']:
+        start_courier_dispatcher()
+    else:
+        start_bot()
@@ -0,0 +1,107 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_histograms = {}
+_counters = {}
+_collectors = []
+_lock = threading.Lock()
+
+logger = logging.getLogger('tg_bot')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+def observe(name, seconds, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {'buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'sum': 0.0, 'count': 0}
+        histogram['buckets'][bucket] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+
+def increment(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+@contextmanager
+def timed(name, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        increment(f'{name}_errors_total', **labels)
+        raise
+    finally:
+        observe(f'{name}_seconds', time.perf_counter() - started, **labels)
+
+
+def register_collector(prefix, collector):
+    _collectors.append((prefix, collector))
+
+
+def render_metrics():
+    with _lock:
+        histograms = {key: dict(value, buckets=list(value['buckets'])) for key, value in _histograms.items()}
+        counters = dict(_counters)
+
+    rows = []
+    for (name, labels), histogram in sorted(histograms.items()):
+        cumulative = 0
+        for upper_bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram['buckets']):
+            cumulative += count
+            rows.append(f'{name}_bucket{format_labels(labels + (("le", upper_bound),))} {cumulative}')
+        rows.append(f'{name}_sum{format_labels(labels)} {histogram["sum"]}')
+        rows.append(f'{name}_count{format_labels(labels)} {histogram["count"]}')
+    for (name, labels), value in sorted(counters.items()):
+        rows.append(f'{name}{format_labels(labels)} {value}')
+    for prefix, collector in _collectors:
+        try:
+            values = collector()
+        except Exception as err:
+            logger.warning(f'Metrics collector {prefix} failed: {err}')
+            continue
+        for name, value in values.items():
+            rows.append(f'{prefix}_{name} {value}')
+
+    return '\n'.join(rows) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        payload = render_metrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, listen='0.0.0.0'):
+    server = ThreadingHTTPServer((listen, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f'Metrics available on {listen}:{port}/metrics')
+    return server
@@ -1,87 +1,248 @@
 import os
+import json
 import logging
-from datetime import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from dotenv import load_dotenv
 import requests
+from requests.adapters import HTTPAdapter
 from slugify import slugify
+from urllib3.util.retry import Retry
+
+from metrics import timed, increment, register_collector
+from database import get_catalog_version, bump_catalog_version, get_shared_cached, get_database_connection
 
 load_dotenv()
 MOLTIN_CLIENT_ID = os.getenv('MOLTIN_CLIENT_ID')
 MOLTIN_SECRET = os.getenv('MOLTIN_SECRET')
-MOLTIN_ENDPOINT = 'https://api.moltin.com'
+MOLTIN_ENDPOINT = os.getenv('MOLTIN_ENDPOINT', 'https://api.moltin.com')
 MOLTIN_API_VERSION = 'v2'
+MOLTIN_POOL_SIZE = int(os.getenv('MOLTIN_POOL_SIZE', 10))
+MOLTIN_CONNECT_TIMEOUT = float(os.getenv('MOLTIN_CONNECT_TIMEOUT', 3.05))
+MOLTIN_READ_TIMEOUT = float(os.getenv('MOLTIN_READ_TIMEOUT', 10))
+MOLTIN_RETRIES = int(os.getenv('MOLTIN_RETRIES', 3))
+MOLTIN_RETRY_BACKOFF = float(os.getenv('MOLTIN_RETRY_BACKOFF', 0.3))
+MOLTIN_RETRY_STATUSES = (429, 500, 502, 503, 504)
+MOLTIN_PATH_WORDS = {'products', 'files', 'carts', 'items', 'flows', 'entries', 'fields', 'customers',
+                     'relationships', 'main-image'}
+MOLTIN_PAGE_LIMIT = int(os.getenv('MOLTIN_PAGE_LIMIT', 100))
+CATALOG_CACHE_TTL = int(os.getenv('CATALOG_CACHE_TTL', 600))
+CART_MIRROR_TTL = int(os.getenv('CART_MIRROR_TTL', 3600))
 
 logger = logging.getLogger('moltin')
 
+_session = None
 _token = None
 _token_expires = None
+_token_lock = threading.Lock()
+_token_refresh_timer = None
 TOKEN_EXPIRES_TIMESHIFT = 10
+TOKEN_REFRESH_AHEAD = int(os.getenv('MOLTIN_TOKEN_REFRESH_AHEAD', 60))
+
+# KEYS[1] - cart, KEYS[2] - cart version, ARGV[1] - version seen before the fetch, ARGV[2] - cart json, ARGV[3] - ttl
+FILL_CART_MIRROR_SCRIPT = '''
+if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+    return 0
+end
+local version = redis.call('INCR', KEYS[2])
+redis.call('SET', KEYS[1], '{"version": ' .. version .. ', "cart": ' .. ARGV[2] .. '}', 'EX', ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return version
+'''
+
+_catalog_cache = {}
+_fill_cart_mirror_script = None
+
+
+def get_session():
+    global _session
+    if _session is None:
+        retry = Retry(
+            total=MOLTIN_RETRIES,
+            backoff_factor=MOLTIN_RETRY_BACKOFF,
+            status_forcelist=MOLTIN_RETRY_STATUSES,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MOLTIN_POOL_SIZE, max_retries=retry)
+        _session = requests.Session()
+        _session.mount(MOLTIN_ENDPOINT, adapter)
+    return _session
+
+
+def get_session_stats():
+    requests_count, connections_count = 0, 0
+    for adapter in get_session().adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            if pool is None:
+                continue
+            requests_count += pool.num_requests
+            connections_count += pool.num_connections
+    return {
+        'requests': requests_count,
+        'connections': connections_count,
+        'reused': requests_count - connections_count,
+    }
+
+
+def request(method, path, raise_for_status=True, **kwargs):
+    headers = kwargs.pop('headers', {})
+    token = get_token()
+    headers['Authorization'] = token
+    kwargs.setdefault('timeout', (MOLTIN_CONNECT_TIMEOUT, MOLTIN_READ_TIMEOUT))
+
+    url = f'{MOLTIN_ENDPOINT}/{MOLTIN_API_VERSION}/{path}'
+    endpoint = get_endpoint_name(method, path)
+    with timed('moltin_request', endpoint=endpoint):
+        response = get_session().request(method, url, headers=headers, **kwargs)
+    if response.status_code == 401 and 'files' not in kwargs:
+        logger.warning('Moltin rejected the token, refreshing and retrying')
+        headers['Authorization'] = get_token(rejected_token=token)
+        with timed('moltin_request', endpoint=endpoint):
+            response = get_session().request(method, url, headers=headers, **kwargs)
+    if raise_for_status and not response.ok:
+        increment('moltin_request_errors_total', endpoint=endpoint)
+        response.raise_for_status()
+
+    return response
+
+
+def iter_pages(path, page_limit=MOLTIN_PAGE_LIMIT, params=None):
+    def fetch_page(offset):
+        page_params = dict(params or {}, **{'page[limit]': page_limit, 'page[offset]': offset})
+        return request('GET', path, params=page_params).json()
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        offset = 0
+        next_page = executor.submit(fetch_page, offset)
+        while next_page:
+            page = next_page.result()
+            offset += page_limit
+            has_next = page['data'] and page.get('links', {}).get('next')
+            next_page = executor.submit(fetch_page, offset) if has_next else None
+            yield page['data']
+    finally:
+        executor.shutdown(wait=False)
+
+
+def iter_entries(path, page_limit=MOLTIN_PAGE_LIMIT, params=None):
+    for page in iter_pages(path, page_limit, params):
+        yield from page
+
 
+def get_endpoint_name(method, path):
+    parts = path.split('?')[0].split('/')
+    return ' '.join([method] + ['/'.join(part if part in MOLTIN_PATH_WORDS else '{id}' for part in parts)])
 
-def get_token():
+
+def get_valid_token():
+    if _token and _token_expires > int(time.time()):
+        return _token
+
+
+def get_token(rejected_token=None):
+    token = get_valid_token()
+    if token and token != rejected_token:
+        return token
+
+    with _token_lock:
+        token = get_valid_token()
+        if token and token != rejected_token:
+            return token
+        return refresh_token()
+
+
+def refresh_token():
     global _token, _token_expires
-    if not _token or _token_expires <= int(datetime.utcnow().timestamp()):
-        data = {
-            'client_id': MOLTIN_CLIENT_ID,
-            'client_secret': MOLTIN_SECRET,
-            'grant_type': 'client_credentials'
-        }
-        response = requests.post(f'{MOLTIN_ENDPOINT}/oauth/access_token', data=data)
+    data = {
+        'client_id': MOLTIN_CLIENT_ID,
+        'client_secret': MOLTIN_SECRET,
+        'grant_type': 'client_credentials'
+    }
+    with timed('moltin_token_refresh'):
+        response = get_session().post(f'{MOLTIN_ENDPOINT}/oauth/access_token', data=data,
+                                      timeout=(MOLTIN_CONNECT_TIMEOUT, MOLTIN_READ_TIMEOUT))
         response.raise_for_status()
-        _token = f'{response.json()["token_type"]} {response.json()["access_token"]}'
-        _token_expires = response.json()['expires'] - TOKEN_EXPIRES_TIMESHIFT
+    increment('moltin_token_refresh_total')
+    _token = f'{response.json()["token_type"]} {response.json()["access_token"]}'
+    _token_expires = response.json()['expires'] - TOKEN_EXPIRES_TIMESHIFT
+    schedule_token_refresh(_token_expires - int(time.time()) - TOKEN_REFRESH_AHEAD)
     return _token
 
 
-def add_product(product):
-    headers = {
-        'Authorization': get_token(),
-        'Content-Type': 'application/json',
+def schedule_token_refresh(delay):
+    global _token_refresh_timer
+    if _token_refresh_timer:
+        _token_refresh_timer.cancel()
+    _token_refresh_timer = threading.Timer(max(delay, 0), refresh_token_in_background)
+    _token_refresh_timer.daemon = True
+    _token_refresh_timer.start()
+
+
+def refresh_token_in_background():
+    try:
+        with _token_lock:
+            refresh_token()
+    except requests.RequestException as err:
+        increment('moltin_token_refresh_errors_total')
+        logger.error(f'Background token refresh failed: {err}')
+
+
+def get_product_data(product):
+    return {
+        'type': 'product',
+        'name': product['name'],
+        'slug': slugify(product['name']),
+        'sku': str(product['id']),
+        'description': product['description'],
+        'manage_stock': False,
+        'price': [
+            {
+                'amount': product['price'],
+                'currency': 'RUR',
+                'includes_tax': True
+            }
+        ],
+        'status': 'live',
+        'commodity_type': 'physical'
     }
 
+
+def add_product(product):
     data = {
-        'data': {
-            'type': 'product',
-            'name': product['name'],
-            'slug': slugify(product['name']),
-            'sku': str(product['id']),
-            'description': product['description'],
-            'manage_stock': False,
-            'price': [
-                {
-                    'amount': product['price'],
-                    'currency': 'RUR',
-                    'includes_tax': True
-                }
-            ],
-            'status': 'live',
-            'commodity_type': 'physical'
-        }
+        'data': get_product_data(product)
     }
 
-    url = f'{MOLTIN_ENDPOINT}/{MOLTIN_API_VERSION}/products'
-    response = requests.post(url, headers=headers, json=data)
-    response.raise_for_status()
+    response = request('POST', 'products', json=data)
 
     product_id = response.json()['data']['id']
 
     return product_id
 
 
-def load_image(image_path):
-    headers = {
-        'Authorization': get_token()
+def update_product(product_id, product):
+    data = {
+        'data': dict(get_product_data(product), id=product_id)
     }
 
+    request('PUT', f'products/{product_id}', json=data)
+
+
+def delete_product(product_id):
+    request('DELETE', f'products/{product_id}')
+
+
+def load_image_stream(file_name, stream):
     files = {
-        'file': (image_path, open(image_path, 'rb')),
+        'file': (file_name, stream),
         'public': (None, 'true'),
     }
-    url = f'{MOLTIN_ENDPOINT}/{MOLTIN_API_VERSION}/files'
-
-    response = requests.post(url, headers=headers, files=files)
-    response.raise_for_status()
+    response = request('POST', 'files', files=files)
 
     file_id = response.json()['data']['id']
 
@@ -89,11 +250,6 @@ def load_image(image_path):
 
 
 def link_product_image(product_id, image_id):
-    headers = {
-        'Authorization': get_token(),
-        'Content-Type': 'application/json',
-    }
-
     data = {
         'data': {
             'type': 'main_image',
@@ -101,9 +257,7 @@ def link_product_image(product_id, image_id):
         }
     }
 
-    url = f'{MOLTIN_ENDPOINT}/{MOLTIN_API_VERSION}/products/{product_id}/relationships/main-image'
-    response = requests.post(url, headers=headers, json=data)
-    response.raise_for_status()
+    response = request('POST', f'products/{product_id}/relationships/main-image', json=data)
 
     product_id = response.json()['data']['id']
 
@@ -111,11 +265,6 @@ def link_product_image(product_id, image_id):
 
 
 def add_flow(name, description=None):
-    headers = {
-        'Authorization': get_token(),
-        'Content-Type': 'application/json',
-    }
-
     data = {
         'data': {
             'type': 'flow',
@@ -126,9 +275,7 @@ def add_flow(name, description=None):
         }
     }
 
-    url = f'{MOLTIN_ENDPOINT}/{MOLTIN_API_VERSION}/flows'
-    response = requests.post(url, headers=headers, json=data)
-    response.raise_for_status()
+    response = request('POST', 'flows', json=data)
 
     flow_id = response.json()['data']['id']
 
@@ -136,11 +283,6 @@ def add_flow(name, description=None):
 
 
 def add_flow_filed(flow_id, field):
-    headers = {
-        'Authorization': get_token(),
-        'Content-Type': 'application/json',
-    }
-
     data = {
         'data': {
             'type': 'field',
@@ -164,9 +306,7 @@ def add_flow_filed(flow_id, field):
         }
     }
 
-    url = f'{MOLTIN_ENDPOINT}/{MOLTIN_API_VERSION}/fields'
-    response = requests.post(url, headers=headers, json=data)
-    response.raise_for_status()
+    response = request('POST', 'fields', json=data)
 
     product_id = response.json()['data']['id']
 
@@ -174,11 +314,6 @@ def add_flow_filed(flow_id, field):
 
 
 def add_flow_entry(flow_slug, entry):
-    headers = {
-        'Authorization': get_token(),
-        'Content-Type': 'application/json',
-    }
-
     data = {
         'data': {
             'type': 'entry',
@@ -189,66 +324,79 @@ def add_flow_entry(flow_slug, entry):
     for field, value in entry.items():
         data['data'][field] = value
 
-    url = f'{MOLTIN_ENDPOINT}/{MOLTIN_API_VERSION}/flows/{flow_slug}/entries'
-    response = requests.post(url, headers=headers, json=data)
-    response.raise_for_status()
+    response = request('POST', f'flows/{flow_slug}/entries', json=data)
 
     flow_id = response.json()['data']['id']
 
     return flow_id
 
 
-def get_flow_entries(flow_slug):
-    headers = {
-        'Authorization': get_token(),
+def update_flow_entry(flow_slug, entry_id, entry):
+    data = {
+        'data': dict(entry, type='entry', id=entry_id)
     }
 
-    url = f'{MOLTIN_ENDPOINT}/{MOLTIN_API_VERSION}/flows/{flow_slug}/entries'
-    response = requests.get(url, headers=headers)
+    request('PUT', f'flows/{flow_slug}/entries/{entry_id}', json=data)
 
-    response.raise_for_status()
 
-    return response.json()['data']
+def delete_flow_entry(flow_slug, entry_id):
+    request('DELETE', f'flows/{flow_slug}/entries/{entry_id}')
 
 
-def get_flow_entry(flow_slug, entry_id):
-    headers = {
-        'Authorization': get_token(),
-    }
+def get_flow_entries(flow_slug, stream=False):
+    entries = iter_entries(f'flows/{flow_slug}/entries')
+    if stream:
+        return entries
 
-    url = f'{MOLTIN_ENDPOINT}/{MOLTIN_API_VERSION}/flows/{flow_slug}/entries/{entry_id}'
-    response = requests.get(url, headers=headers)
+    return list(entries)
 
-    response.raise_for_status()
+
+def get_flow_entry(flow_slug, entry_id):
+    response = request('GET', f'flows/{flow_slug}/entries/{entry_id}')
 
     return response.json()['data']
 
 
-def get_products():
-    headers = {
-        'Authorization': get_token(),
-    }
+def get_catalog_cached(key, loader):
+    now = time.monotonic()
+    version = get_catalog_version()
+    cached = _catalog_cache.get(key)
+    if cached and cached[0] == version and cached[1] > now:
+        return cached[2]
 
-    url = f'{MOLTIN_ENDPOINT}/{MOLTIN_API_VERSION}/products'
+    value = get_shared_cached(key, loader, version)
+    _catalog_cache[key] = (version, now + CATALOG_CACHE_TTL, value)
+    return value
 
-    response = requests.get(url, headers=headers)
 
-    response.raise_for_status()
+def invalidate_catalog_cache():
+    _catalog_cache.clear()
+    bump_catalog_version()
+    logger.debug('Catalog cache invalidated')
 
-    return response.json()['data']
+
+def get_products(stream=False):
+    if stream:
+        return iter_entries('products')
+
+    return get_catalog_cached('products', fetch_products)
+
+
+def fetch_products():
+    return list(iter_entries('products'))
 
 
 def get_product(product_id):
-    headers = {
-        'Authorization': get_token(),
-    }
+    return get_catalog_cached(f'product:{product_id}', lambda: fetch_product(product_id))
 
-    url = f'{MOLTIN_ENDPOINT}/{MOLTIN_API_VERSION}/products/{product_id}'
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
 
-    data = response.json()['data']
+def fetch_product(product_id):
+    response = request('GET', f'products/{product_id}')
 
+    return parse_product(response.json()['data'])
+
+
+def parse_product(data):
     product = {
         'id': data['id'],
         'name': data['name'],
@@ -262,11 +410,6 @@ def get_product(product_id):
 
 
 def add_cart_item(customer_id, product_id, quantity=1):
-    headers = {
-        'Authorization': get_token(),
-        'Content-Type': 'application/json',
-    }
-
     data = {
         'data': {
             'id': product_id,
@@ -275,18 +418,11 @@ def add_cart_item(customer_id, product_id, quantity=1):
         }
     }
 
-    url = f'{MOLTIN_ENDPOINT}/{MOLTIN_API_VERSION}/carts/:{customer_id}/items'
-    response = requests.post(url, headers=headers, json=data)
-
-    response.raise_for_status()
+    response = request('POST', f'carts/:{customer_id}/items', json=data)
+    update_cart_mirror(customer_id, response.json())
 
 
 def add_cart_custom_item(customer_id, item_name, price, quantity=1):
-    headers = {
-        'Authorization': get_token(),
-        'Content-Type': 'application/json',
-    }
-
     data = {
         'data': {
             'type': 'custom_item',
@@ -299,35 +435,32 @@ def add_cart_custom_item(customer_id, item_name, price, quantity=1):
         }
     }
 
-    url = f'{MOLTIN_ENDPOINT}/{MOLTIN_API_VERSION}/carts/:{customer_id}/items'
-    response = requests.post(url, headers=headers, json=data)
-
-    response.raise_for_status()
+    response = request('POST', f'carts/:{customer_id}/items', json=data)
+    update_cart_mirror(customer_id, response.json())
 
 
 def remove_cart_item(customer_id, cart_item_id):
-    headers = {
-        'Authorization': get_token(),
-        'Content-Type': 'application/json',
-    }
-    url = f'{MOLTIN_ENDPOINT}/{MOLTIN_API_VERSION}/carts/:{customer_id}/items/{cart_item_id}'
-    response = requests.delete(url, headers=headers)
-
-    response.raise_for_status()
+    response = request('DELETE', f'carts/:{customer_id}/items/{cart_item_id}')
+    update_cart_mirror(customer_id, response.json())
 
 
 def get_cart(customer_id):
-    headers = {
-        'Authorization': get_token(),
-        'Content-Type': 'application/json',
-    }
-    url = f'{MOLTIN_ENDPOINT}/{MOLTIN_API_VERSION}/carts/:{customer_id}/items'
-    response = requests.get(url, headers=headers)
+    cart, version = read_cart_mirror(customer_id)
+    if cart is None:
+        cart = fetch_cart(customer_id)
+        fill_cart_mirror(customer_id, cart, version)
+    return cart
+
+
+def fetch_cart(customer_id):
+    response = request('GET', f'carts/:{customer_id}/items')
+
+    return parse_cart(response.json())
 
-    response.raise_for_status()
 
+def parse_cart(cart):
     products = []
-    for product in response.json()['data']:
+    for product in cart['data']:
         product_info = {
             'id': product['id'],
             'product_id': product.get('product_id', 'id'),
@@ -340,59 +473,96 @@ def get_cart(customer_id):
             'total_price_formatted': product['meta']['display_price']['with_tax']['value']['formatted'],
         }
         products.append(product_info)
-    total_price_formatted = response.json()['meta']['display_price']['with_tax']['formatted']
-    total_price = response.json()['meta']['display_price']['with_tax']['amount']
+    total_price_formatted = cart['meta']['display_price']['with_tax']['formatted']
+    total_price = cart['meta']['display_price']['with_tax']['amount']
 
     return {'products': products, 'total_price_formatted': total_price_formatted, 'total_price': total_price}
 
 
 def delete_cart(customer_id):
-    headers = {
-        'Authorization': get_token(),
-        'Content-Type': 'application/json',
-    }
-    url = f'{MOLTIN_ENDPOINT}/{MOLTIN_API_VERSION}/carts/:{customer_id}'
-    response = requests.delete(url, headers=headers)
+    request('DELETE', f'carts/:{customer_id}')
+    invalidate_cart_mirror(customer_id)
+
+
+def get_cart_mirror_keys(customer_id):
+    return f'cart:{customer_id}', f'cart:{customer_id}:version'
+
+
+def read_cart_mirror(customer_id):
+    cart_key, version_key = get_cart_mirror_keys(customer_id)
+    mirror, version = get_database_connection().mget(cart_key, version_key)
+    version = version.decode() if version else ''
+    if mirror and version:
+        mirror = json.loads(mirror)
+        if mirror['version'] == int(version):
+            increment('moltin_cart_mirror_hits_total')
+            return mirror['cart'], version
+
+    increment('moltin_cart_mirror_misses_total')
+    return None, version
 
-    response.raise_for_status()
+
+def fill_cart_mirror(customer_id, cart, expected_version):
+    # a write-through that landed while the cart was fetched bumps the version, and the older fetch is dropped
+    global _fill_cart_mirror_script
+    if _fill_cart_mirror_script is None:
+        _fill_cart_mirror_script = get_database_connection().register_script(FILL_CART_MIRROR_SCRIPT)
+
+    filled = _fill_cart_mirror_script(keys=get_cart_mirror_keys(customer_id),
+                                      args=[expected_version, json.dumps(cart), CART_MIRROR_TTL])
+    increment('moltin_cart_mirror_fills_total' if filled else 'moltin_cart_mirror_stale_fills_total')
+    return bool(filled)
+
+
+def store_cart_mirror(customer_id, cart):
+    cart_key, version_key = get_cart_mirror_keys(customer_id)
+    db = get_database_connection()
+    version = db.incr(version_key)
+    pipeline = db.pipeline()
+    pipeline.set(cart_key, json.dumps({'version': version, 'cart': cart}), ex=CART_MIRROR_TTL)
+    pipeline.expire(version_key, CART_MIRROR_TTL)
+    pipeline.execute()
+    increment('moltin_cart_mirror_writes_total')
+
+
+def update_cart_mirror(customer_id, response):
+    try:
+        cart = parse_cart(response)
+    except (KeyError, TypeError) as err:
+        logger.warning(f'Cart {customer_id} response is not a full cart, mirror invalidated: {err}')
+        invalidate_cart_mirror(customer_id)
+        return
+    store_cart_mirror(customer_id, cart)
+
+
+def invalidate_cart_mirror(customer_id):
+    _, version_key = get_cart_mirror_keys(customer_id)
+    get_database_connection().incr(version_key)
 
 
 def get_product_image_url(image_id):
-    headers = {
-        'Authorization': get_token(),
-        'Content-Type': 'application/json',
-    }
-    url = f'{MOLTIN_ENDPOINT}/{MOLTIN_API_VERSION}/files/{image_id}'
-    response = requests.get(url, headers=headers)
+    return get_catalog_cached(f'image:{image_id}', lambda: fetch_product_image_url(image_id))
+
 
-    response.raise_for_status()
+def fetch_product_image_url(image_id):
+    response = request('GET', f'files/{image_id}')
 
     return response.json()['data']['link']['href']
 
 
 def get_customer(customer_id=None, email=None):
-    headers = {
-        'Authorization': get_token(),
-        'Content-Type': 'application/json',
-    }
     if customer_id:
-        url = f'{MOLTIN_ENDPOINT}/{MOLTIN_API_VERSION}/customers/:{customer_id}'
+        path = f'customers/:{customer_id}'
     elif email:
-        url = f'{MOLTIN_ENDPOINT}/{MOLTIN_API_VERSION}/customers?filter=eq(email,{email})'
+        path = f'customers?filter=eq(email,{email})'
     else:
         return
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+    response = request('GET', path)
 
     return response.json()['data']
 
 
 def add_customer(name, email):
-    headers = {
-        'Authorization': get_token(),
-        'Content-Type': 'application/json',
-    }
-
     data = {
         'data': {
             'type': 'customer',
@@ -401,9 +571,7 @@ def add_customer(name, email):
         }
     }
 
-    url = f'{MOLTIN_ENDPOINT}/{MOLTIN_API_VERSION}/customers'
-
-    response = requests.post(url, headers=headers, json=data)
+    response = request('POST', 'customers', raise_for_status=False, json=data)
 
     error = response.json().get('errors', [])
 
@@ -417,6 +585,9 @@ def add_customer(name, email):
     return customer_id
 
 
+register_collector('moltin_session', get_session_stats)
+
+
 def main():
     pass
 
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import threading
+
+import aiohttp
+from slugify import slugify
+
+from metrics import timed
+from moltin import MOLTIN_ENDPOINT, MOLTIN_API_VERSION, MOLTIN_POOL_SIZE, \
+    MOLTIN_CONNECT_TIMEOUT, MOLTIN_READ_TIMEOUT, MOLTIN_RETRIES, MOLTIN_RETRY_BACKOFF, MOLTIN_RETRY_STATUSES, \
+    get_valid_token, get_token as get_sync_token, get_endpoint_name, parse_cart, read_cart_mirror, fill_cart_mirror, \
+    update_cart_mirror
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+logger = logging.getLogger('moltin')
+
+_loop = None
+_loop_lock = threading.Lock()
+_session = None
+
+
+def get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='moltin-async', daemon=True).start()
+    return _loop
+
+
+def run(coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, get_loop()).result()
+
+
+def get_session():
+    global _session
+    if _session is None:
+        connector = aiohttp.TCPConnector(limit=MOLTIN_POOL_SIZE)
+        timeout = aiohttp.ClientTimeout(connect=MOLTIN_CONNECT_TIMEOUT, sock_read=MOLTIN_READ_TIMEOUT)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _session
+
+
+async def run_blocking(function, *args):
+    # Redis and the sync token manager block, so they run in the default executor instead of stalling the loop
+    return await asyncio.get_event_loop().run_in_executor(None, function, *args)
+
+
+async def get_token(rejected_token=None):
+    token = get_valid_token()
+    if token and token != rejected_token:
+        return token
+    return await run_blocking(get_sync_token, rejected_token)
+
+
+async def request(method, path, **kwargs):
+    headers = kwargs.pop('headers', {})
+    token = await get_token()
+    url = f'{MOLTIN_ENDPOINT}/{MOLTIN_API_VERSION}/{path}'
+
+    retries = MOLTIN_RETRIES if method in IDEMPOTENT_METHODS else 0
+    token_retried = False
+    attempt = 0
+    while True:
+        headers['Authorization'] = token
+        with timed('moltin_async_request', endpoint=get_endpoint_name(method, path)):
+            async with get_session().request(method, url, headers=headers, **kwargs) as response:
+                if response.status == 401 and not token_retried:
+                    token_retried = True
+                    token = await get_token(rejected_token=token)
+                    continue
+                if response.status in MOLTIN_RETRY_STATUSES and attempt < retries:
+                    await asyncio.sleep(MOLTIN_RETRY_BACKOFF * 2 ** attempt)
+                    attempt += 1
+                    continue
+                response.raise_for_status()
+                if response.status == 204:
+                    return None
+                return await response.json()
+
+
+async def add_flow_entry(flow_slug, entry):
+    data = {
+        'data': dict(entry, type='entry')
+    }
+
+    response = await request('POST', f'flows/{flow_slug}/entries', json=data)
+
+    return response['data']['id']
+
+
+async def add_cart_custom_item(customer_id, item_name, price, quantity=1):
+    data = {
+        'data': {
+            'type': 'custom_item',
+            'name': item_name,
+            'sku': slugify(item_name),
+            'quantity': quantity,
+            'price': {
+                'amount': price
+            }
+        }
+    }
+
+    response = await request('POST', f'carts/:{customer_id}/items', json=data)
+    await run_blocking(update_cart_mirror, customer_id, response)
+
+
+async def get_cart(customer_id):
+    cart, version = await run_blocking(read_cart_mirror, customer_id)
+    if cart is None:
+        cart = await fetch_cart(customer_id)
+        await run_blocking(fill_cart_mirror, customer_id, cart, version)
+    return cart
+
+
+async def fetch_cart(customer_id):
+    response = await request('GET', f'carts/:{customer_id}/items')
+
+    return parse_cart(response)
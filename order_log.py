@@ -0,0 +1,162 @@
+import os
+import argparse
+import logging
+import mmap
+import struct
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+ORDER_LOG_DIR = os.getenv('ORDER_LOG_DIR', 'order_log')
+ORDER_LOG_ROTATE_SECONDS = int(os.getenv('ORDER_LOG_ROTATE_SECONDS', 3600))
+
+SEGMENT_TIME_FORMAT = '%Y%m%dT%H%M%S'
+SEGMENT_SUFFIX = '.events'
+
+CART_ADD = 1
+CART_REMOVE = 2
+DELIVERY_CHOSEN = 3
+PICKUP_CHOSEN = 4
+INVOICE_SENT = 5
+PAYMENT_RECEIVED = 6
+EVENT_NAMES = {
+    CART_ADD: 'cart_add',
+    CART_REMOVE: 'cart_remove',
+    DELIVERY_CHOSEN: 'delivery',
+    PICKUP_CHOSEN: 'pickup',
+    INVOICE_SENT: 'invoice',
+    PAYMENT_RECEIVED: 'payment',
+}
+
+# timestamp, chat id, event, amount, ref (product, cart item or pizzeria uuid).
+# amount is the quantity for cart events and roubles for delivery, invoice and payment
+EVENT_FORMAT = struct.Struct('<dqB3xi16s')
+EVENT_DTYPE = np.dtype([('timestamp', '<f8'), ('chat_id', '<i8'), ('event', 'u1'), ('padding', 'V3'),
+                        ('amount', '<i4'), ('ref', 'V16')])
+assert EVENT_DTYPE.itemsize == EVENT_FORMAT.size
+
+_segment = {'start': None, 'fd': None}
+_lock = threading.Lock()
+
+logger = logging.getLogger('tg_bot')
+
+
+def get_segment_start(timestamp):
+    return int(timestamp // ORDER_LOG_ROTATE_SECONDS * ORDER_LOG_ROTATE_SECONDS)
+
+
+def get_segment_path(segment_start, log_dir=ORDER_LOG_DIR):
+    name = datetime.fromtimestamp(segment_start, timezone.utc).strftime(SEGMENT_TIME_FORMAT)
+    return os.path.join(log_dir, f'{name}{SEGMENT_SUFFIX}')
+
+
+def get_segment_fd(timestamp):
+    segment_start = get_segment_start(timestamp)
+    if _segment['start'] != segment_start:
+        if _segment['fd'] is not None:
+            os.close(_segment['fd'])
+        os.makedirs(ORDER_LOG_DIR, exist_ok=True)
+        _segment['fd'] = os.open(get_segment_path(segment_start), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        _segment['start'] = segment_start
+    return _segment['fd']
+
+
+def encode_ref(ref):
+    if not ref:
+        return bytes(16)
+    return uuid.UUID(str(ref)).bytes
+
+
+def log_order_event(chat_id, event, amount=0, ref=None):
+    timestamp = time.time()
+    try:
+        record = EVENT_FORMAT.pack(timestamp, chat_id, event, int(amount), encode_ref(ref))
+        with _lock:
+            # O_APPEND keeps single-record writes whole even with several bot processes on one log
+            os.write(get_segment_fd(timestamp), record)
+    except (OSError, ValueError) as err:
+        logger.warning(f'Order event {EVENT_NAMES.get(event, event)} for {chat_id} not logged: {err}')
+
+
+def get_segment_paths(since, until, log_dir=ORDER_LOG_DIR):
+    if not os.path.isdir(log_dir):
+        return []
+    paths = []
+    for name in sorted(os.listdir(log_dir)):
+        if not name.endswith(SEGMENT_SUFFIX):
+            continue
+        segment_start = datetime.strptime(name[:-len(SEGMENT_SUFFIX)], SEGMENT_TIME_FORMAT)
+        segment_start = segment_start.replace(tzinfo=timezone.utc).timestamp()
+        if since - ORDER_LOG_ROTATE_SECONDS < segment_start < until:
+            paths.append(os.path.join(log_dir, name))
+    return paths
+
+
+def read_segment(path):
+    with open(path, 'rb') as segment_file:
+        size = os.fstat(segment_file.fileno()).st_size
+        records_count = size // EVENT_DTYPE.itemsize
+        if not records_count:
+            return np.empty(0, dtype=EVENT_DTYPE)
+        with mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            # a torn record at the tail of a segment that is still being written is skipped
+            return np.frombuffer(mapped, dtype=EVENT_DTYPE, count=records_count).copy()
+
+
+def read_events(since, until, log_dir=ORDER_LOG_DIR):
+    segments = [read_segment(path) for path in get_segment_paths(since, until, log_dir)]
+    if not segments:
+        return np.empty(0, dtype=EVENT_DTYPE)
+    events = np.concatenate(segments)
+    return events[(events['timestamp'] >= since) & (events['timestamp'] < until)]
+
+
+def get_daily_report(day, log_dir=ORDER_LOG_DIR):
+    since = datetime.combine(day, datetime.min.time(), timezone.utc).timestamp()
+    until = since + timedelta(days=1).total_seconds()
+    events = read_events(since, until, log_dir)
+
+    report = {'events': len(events), 'customers': len(np.unique(events['chat_id']))}
+    for event, name in EVENT_NAMES.items():
+        report[name] = int(np.count_nonzero(events['event'] == event))
+
+    payments = events[events['event'] == PAYMENT_RECEIVED]
+    deliveries = events[events['event'] == DELIVERY_CHOSEN]
+    report['revenue'] = int(payments['amount'].sum())
+    report['paying_customers'] = len(np.unique(payments['chat_id']))
+    report['delivery_revenue'] = int(deliveries['amount'].sum())
+
+    cart_adds = events[events['event'] == CART_ADD]
+    refs, product_indexes = np.unique(cart_adds['ref'], return_inverse=True)
+    counts = np.bincount(product_indexes, weights=cart_adds['amount'], minlength=len(refs))
+    report['top_products'] = Counter({str(uuid.UUID(bytes=bytes(ref))): int(count)
+                                      for ref, count in zip(refs, counts)}).most_common(5)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Дневной отчет по журналу заказов')
+    parser.add_argument('--date', type=lambda value: datetime.strptime(value, '%Y-%m-%d').date(),
+                        default=datetime.now(timezone.utc).date() - timedelta(days=1))
+    parser.add_argument('--log-dir', default=ORDER_LOG_DIR)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    report = get_daily_report(args.date, args.log_dir)
+    for name, value in report.items():
+        if name == 'top_products':
+            for product_id, count in value:
+                print(f'product\t{product_id}\t{count}')
+        else:
+            print(f'{name}\t{value}')
+    print(f'seconds\t{time.perf_counter() - started:.2f}')
+
+
+if __name__ == '__main__':
+    main()
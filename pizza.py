@@ -1,48 +1,207 @@
+import argparse
+import asyncio
+import hashlib
 import json
 import os
 import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 
 import requests
 from slugify import slugify
 import yandex_geocoder
 from geopy.distance import lonlat, distance
 
-from moltin import load_image, add_product, link_product_image, add_flow_entry, get_flow_entries, get_flow_entry, \
-    get_cart, add_cart_custom_item
+from metrics import timed, register_collector
+from database import get_catalog_version, get_database_connection
+from moltin import load_image_stream, add_product, link_product_image, add_flow_entry, get_flow_entries, get_flow_entry, \
+    get_catalog_cached, invalidate_catalog_cache
+import moltin_async
+from spatial import SpatialIndex, geohash_encode
 
 MENU_FILE = 'menu.json'
 ADDRESSES_FILE = 'addresses.json'
+MENU_CHECKPOINT_FILE = 'menu.checkpoint.json'
+DELIVERY_ZONES_FILE = os.getenv('DELIVERY_ZONES_FILE', 'delivery_zones.json')
+MENU_IMPORT_WORKERS = int(os.getenv('MENU_IMPORT_WORKERS', 8))
+MENU_IMPORT_RATE = float(os.getenv('MENU_IMPORT_RATE', 10))
 PIZZERIA_FLOW_SLUG = 'pizzeria'
 CUSTOMER_LOCATION_FLOW_SLUG = 'customer_location'
+CUSTOMER_LOCATION_INDEX_KEY = 'customer_location:latest'
+PRODUCT_PHOTOS_KEY = 'telegram:product_photos'
 DELIVERY_ITEM_NAME = 'Доставка'
+DELIVERY_ITEM_SKU = slugify(DELIVERY_ITEM_NAME)
+CART_VIEW_CACHE_SIZE = 1024
+NEAREST_PIZZERIA_CANDIDATES = 3
+
+GEOCODE_CACHE_TTL = int(os.getenv('GEOCODE_CACHE_TTL', 30 * 24 * 60 * 60))
+GEOCODE_NEGATIVE_CACHE_TTL = int(os.getenv('GEOCODE_NEGATIVE_CACHE_TTL', 24 * 60 * 60))
+GEOCODE_LRU_SIZE = int(os.getenv('GEOCODE_LRU_SIZE', 1024))
+GEOCODE_KEY_PREFIX = 'geocode'
+ADDRESS_ABBREVIATIONS = {
+    'ул': 'улица',
+    'пр': 'проспект',
+    'пр-т': 'проспект',
+    'просп': 'проспект',
+    'пер': 'переулок',
+    'б-р': 'бульвар',
+    'бул': 'бульвар',
+    'ш': 'шоссе',
+    'наб': 'набережная',
+    'пл': 'площадь',
+    'г': 'город',
+    'д': 'дом',
+    'корп': 'корпус',
+    'к': 'корпус',
+    'стр': 'строение',
+}
+
+DELIVERY_OPTIONS = {
+    0.5: 0,
+    5: 100,
+    20: 300,
+}
+
+_pizzeria_index = None
+_pizzeria_index_version = None
+
+_delivery_zones = None
+_delivery_zones_version = None
+
+_geocode_cache = OrderedDict()
+_geocode_cache_lock = threading.Lock()
+_geocode_stats = {'local_hits': 0, 'redis_hits': 0, 'misses': 0}
 
 logger = logging.getLogger('pizza')
 
 
-def update_menu(menu_file):
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def load_checkpoint(checkpoint_file):
+    if not os.path.exists(checkpoint_file):
+        return {}
+    with open(checkpoint_file, 'r') as file:
+        return json.load(file)
+
+
+def save_checkpoint(checkpoint_file, checkpoint):
+    tmp_file = f'{checkpoint_file}.tmp'
+    with open(tmp_file, 'w') as file:
+        json.dump(checkpoint, file)
+    os.replace(tmp_file, checkpoint_file)
+
+
+def get_menu_product(pizza):
+    return {
+        'id': pizza['id'],
+        'name': pizza['name'],
+        'description': pizza['description'],
+        'price': pizza['price'],
+    }
+
+
+def import_pizza(pizza, progress, rate_limiter):
+    if 'product_id' not in progress:
+        rate_limiter.wait()
+        progress['product_id'] = add_product(get_menu_product(pizza))
+
+    if 'image_id' not in progress:
+        with requests.get(pizza['product_image']['url'], stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            rate_limiter.wait()
+            progress['image_id'] = load_image_stream(f'{pizza["id"]}.jpg', response.raw)
+
+    if not progress.get('linked'):
+        rate_limiter.wait()
+        link_product_image(progress['product_id'], progress['image_id'])
+        progress['linked'] = True
+
+    return progress
+
+
+def update_menu(menu_file, checkpoint_file=MENU_CHECKPOINT_FILE):
     with open(menu_file, 'r') as file:
         menu = json.load(file)
 
-    for pizza in menu:
-        image_url = pizza['product_image']['url']
-        image_name = f'{pizza["id"]}.jpg'
-        response = requests.get(image_url)
+    checkpoint = load_checkpoint(checkpoint_file)
+    checkpoint_lock = threading.Lock()
+    rate_limiter = RateLimiter(MENU_IMPORT_RATE)
+
+    def import_with_checkpoint(pizza):
+        pizza_id = str(pizza['id'])
+        with checkpoint_lock:
+            progress = dict(checkpoint.get(pizza_id, {}))
+        try:
+            import_pizza(pizza, progress, rate_limiter)
+        finally:
+            with checkpoint_lock:
+                checkpoint[pizza_id] = progress
+                save_checkpoint(checkpoint_file, checkpoint)
+
+    pending = [pizza for pizza in menu if not checkpoint.get(str(pizza['id']), {}).get('linked')]
+    logger.info(f'Importing {len(pending)} of {len(menu)} pizzas')
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=MENU_IMPORT_WORKERS) as executor:
+        futures = {executor.submit(import_with_checkpoint, pizza): pizza for pizza in pending}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as err:
+                failed += 1
+                logger.error(f'Pizza {futures[future]["id"]} import failed: {err}')
+
+    clear_product_photo_file_ids()
+    invalidate_catalog_cache()
+
+    if failed:
+        logger.error(f'{failed} pizzas failed, rerun update_menu to resume from {checkpoint_file}')
+    elif os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
 
-        with open(image_name, 'wb') as image:
-            image.write(response.content)
 
-        product = {
-            'id': pizza['id'],
-            'name': pizza['name'],
-            'description': pizza['description'],
-            'price': pizza['price'],
-        }
+def get_product_photo_file_id(image_id):
+    file_id = get_database_connection().hget(PRODUCT_PHOTOS_KEY, image_id)
+    return file_id.decode() if file_id else None
 
-        moltin_product_id = add_product(product)
-        moltin_image_id = load_image(image_name)
-        link_product_image(moltin_product_id, moltin_image_id)
 
-        os.remove(image_name)
+def save_product_photo_file_id(image_id, file_id):
+    get_database_connection().hset(PRODUCT_PHOTOS_KEY, image_id, file_id)
+
+
+def forget_product_photo_file_id(image_id):
+    get_database_connection().hdel(PRODUCT_PHOTOS_KEY, image_id)
+
+
+def clear_product_photo_file_ids():
+    get_database_connection().delete(PRODUCT_PHOTOS_KEY)
+
+
+def get_pizzeria_entry(address):
+    return {
+        'address': address['address']['full'],
+        'alias': address['alias'],
+        'longitude': address['coordinates']['lon'],
+        'latitude': address['coordinates']['lat'],
+    }
 
 
 def update_addresses(addresses_file):
@@ -50,84 +209,276 @@ def update_addresses(addresses_file):
         addresses = json.load(file)
 
     for address in addresses:
-        pizzeria = {
-            'address': address['address']['full'],
-            'alias': address['alias'],
-            'longitude': address['coordinates']['lon'],
-            'latitude': address['coordinates']['lat'],
-        }
+        pizzeria = get_pizzeria_entry(address)
 
         add_flow_entry(PIZZERIA_FLOW_SLUG, pizzeria)
 
+    invalidate_catalog_cache()
+
+
+def normalize_address(address):
+    words = re.findall(r'[\w/-]+', address.lower().replace('ё', 'е'))
+    return ' '.join(ADDRESS_ABBREVIATIONS.get(word, word) for word in words)
+
 
 def get_address_coordinates(address):
+    normalized_address = normalize_address(address)
+    now = time.monotonic()
+    with _geocode_cache_lock:
+        cached = _geocode_cache.get(normalized_address)
+        if cached and cached[0] > now:
+            _geocode_cache.move_to_end(normalized_address)
+            _geocode_stats['local_hits'] += 1
+            return cached[1]
+
+    db = get_database_connection()
+    cache_key = f'{GEOCODE_KEY_PREFIX}:{normalized_address}'
+    cached = db.get(cache_key)
+    if cached is not None:
+        coordinates = json.loads(cached)
+        coordinates = tuple(coordinates) if coordinates else None
+        ttl = db.ttl(cache_key)
+        source = 'redis_hits'
+    else:
+        coordinates = geocode_address(address)
+        ttl = GEOCODE_CACHE_TTL if coordinates else GEOCODE_NEGATIVE_CACHE_TTL
+        db.set(cache_key, json.dumps(coordinates), ex=ttl)
+        source = 'misses'
+
+    with _geocode_cache_lock:
+        _geocode_stats[source] += 1
+        _geocode_cache[normalized_address] = (now + max(ttl, 0), coordinates)
+        _geocode_cache.move_to_end(normalized_address)
+        while len(_geocode_cache) > GEOCODE_LRU_SIZE:
+            _geocode_cache.popitem(last=False)
+
+    return coordinates
+
+
+def geocode_address(address):
     try:
-        coordinates = yandex_geocoder.Client.coordinates(address)
+        with timed('geocoder_request'):
+            coordinates = yandex_geocoder.Client.coordinates(address)
     except yandex_geocoder.exceptions.YandexGeocoderAddressNotFound:
         return None
     return coordinates
 
 
-def get_nearest_pizzeria(coordinates):
+def get_geocode_stats():
+    with _geocode_cache_lock:
+        stats = dict(_geocode_stats)
+    total = sum(stats.values())
+    stats['hit_rate'] = round((stats['local_hits'] + stats['redis_hits']) / total, 3) if total else 0
+    return stats
+
+
+def get_pizzeria_index():
+    global _pizzeria_index, _pizzeria_index_version
+    version = get_catalog_version()
+    if _pizzeria_index is None or _pizzeria_index_version != version:
+        pizzerias = [(pizzeria, pizzeria['latitude'], pizzeria['longitude']) for pizzeria in get_pizzerias()]
+        _pizzeria_index = SpatialIndex(pizzerias)
+        _pizzeria_index_version = version
+        logger.debug(f'Pizzeria index rebuilt with {_pizzeria_index.size} entries')
+    return _pizzeria_index
+
+
+def get_nearest_pizzerias(coordinates, count=1):
+    longitude, latitude = coordinates
+    candidates = get_pizzeria_index().nearest(latitude, longitude, count + NEAREST_PIZZERIA_CANDIDATES - 1)
+
     pizzerias = []
-    for pizzeria in get_flow_entries(PIZZERIA_FLOW_SLUG):
+    for pizzeria, _ in candidates:
         pizzeria_coodrinates = (pizzeria['latitude'], pizzeria['longitude'])
         pizzeria_distance = round(distance(pizzeria_coodrinates, lonlat(*coordinates)).km, 3)
         pizzerias.append((pizzeria['id'], pizzeria_distance))
 
-    nearest_pizzeria = min(pizzerias, key=lambda x: x[1])
+    return sorted(pizzerias, key=lambda x: x[1])[:count]
+
+
+def get_nearest_pizzeria(coordinates):
+    nearest_pizzeria, = get_nearest_pizzerias(coordinates)
 
     return nearest_pizzeria
 
 
+def get_delivery_price(distance):
+    for distance_limit, price in DELIVERY_OPTIONS.items():
+        if distance <= distance_limit:
+            return price
+
+
+def get_pizzerias_hash(pizzerias):
+    coordinates = sorted((pizzeria['id'], round(float(pizzeria['latitude']), 6), round(float(pizzeria['longitude']), 6))
+                         for pizzeria in pizzerias)
+    return hashlib.sha1(json.dumps(coordinates).encode()).hexdigest()
+
+
+def load_delivery_zones(zones_file):
+    if not os.path.exists(zones_file):
+        return None
+    with open(zones_file, 'r') as file:
+        zones = json.load(file)
+
+    if zones['pizzerias_hash'] != get_pizzerias_hash(get_pizzerias()):
+        logger.warning(f'{zones_file} was built for other pizzerias, rebuild it with delivery_zones.py')
+        return None
+    if zones['delivery_options'] != [[limit, price] for limit, price in DELIVERY_OPTIONS.items()]:
+        logger.warning(f'{zones_file} was built for other delivery prices, rebuild it with delivery_zones.py')
+        return None
+    return zones
+
+
+def get_delivery_zones():
+    global _delivery_zones, _delivery_zones_version
+    version = get_catalog_version()
+    if _delivery_zones_version != version:
+        _delivery_zones = load_delivery_zones(DELIVERY_ZONES_FILE)
+        _delivery_zones_version = version
+    return _delivery_zones
+
+
+def get_delivery_quote(coordinates):
+    zones = get_delivery_zones()
+    longitude, latitude = coordinates
+    cell = zones and zones['cells'].get(geohash_encode(latitude, longitude, zones['precision']))
+    if cell:
+        pizzeria_number, delivery_price = cell
+        pizzeria_id = zones['pizzerias'][pizzeria_number]
+        pizzeria = get_pizzeria(pizzeria_id)
+        pizzeria_distance = round(distance((pizzeria['latitude'], pizzeria['longitude']), lonlat(*coordinates)).km, 3)
+        return pizzeria_id, pizzeria_distance, delivery_price
+
+    pizzeria_id, pizzeria_distance = get_nearest_pizzeria(coordinates)
+    return pizzeria_id, pizzeria_distance, get_delivery_price(pizzeria_distance)
+
+
+def get_pizzerias():
+    return get_catalog_cached('pizzerias', lambda: get_flow_entries(PIZZERIA_FLOW_SLUG))
+
+
 def get_pizzeria(pizzeria_id):
-    return get_flow_entry(PIZZERIA_FLOW_SLUG, pizzeria_id)
+    return get_catalog_cached(f'pizzeria:{pizzeria_id}', lambda: get_flow_entry(PIZZERIA_FLOW_SLUG, pizzeria_id))
 
 
-def add_customer_location(customer_location):
-    return add_flow_entry(CUSTOMER_LOCATION_FLOW_SLUG, customer_location)
+def index_customer_location(customer_location):
+    location = {
+        'longitude': customer_location['longitude'],
+        'latitude': customer_location['latitude'],
+    }
+    get_database_connection().hset(CUSTOMER_LOCATION_INDEX_KEY, str(customer_location['customer_id']),
+                                   json.dumps(location))
 
 
 def get_customer_location(customer_id):
-    locations = [location for location in get_flow_entries(CUSTOMER_LOCATION_FLOW_SLUG) if
-                 location['customer_id'] == customer_id]
+    location = get_database_connection().hget(CUSTOMER_LOCATION_INDEX_KEY, str(customer_id))
+    if location:
+        location = json.loads(location)
+        return location['longitude'], location['latitude']
+
+    logger.warning(f'Customer {customer_id} is missing in location index, scanning flow')
+    locations = [location for location in get_flow_entries(CUSTOMER_LOCATION_FLOW_SLUG, stream=True) if
+                 str(location['customer_id']) == str(customer_id)]
     current_location = max(locations, key=lambda x: x['meta']['timestamps']['created_at'])
     return current_location['longitude'], current_location['latitude']
 
 
+def rebuild_customer_location_index():
+    latest_locations = {}
+    for location in get_flow_entries(CUSTOMER_LOCATION_FLOW_SLUG, stream=True):
+        customer_id = str(location['customer_id'])
+        created_at = location['meta']['timestamps']['created_at']
+        if customer_id not in latest_locations or latest_locations[customer_id][0] < created_at:
+            latest_locations[customer_id] = (created_at, location)
+
+    index = {
+        customer_id: json.dumps({'longitude': location['longitude'], 'latitude': location['latitude']})
+        for customer_id, (_, location) in latest_locations.items()
+    }
+    db = get_database_connection()
+    pipeline = db.pipeline()
+    pipeline.delete(CUSTOMER_LOCATION_INDEX_KEY)
+    if index:
+        pipeline.hmset(CUSTOMER_LOCATION_INDEX_KEY, index)
+    pipeline.execute()
+    logger.info(f'Customer location index rebuilt with {len(index)} customers')
+
+
 def is_delivery_in_cart(cart):
-    return [product for product in cart['products'] if product['sku'] == slugify(DELIVERY_ITEM_NAME)] != []
+    return any(product['sku'] == DELIVERY_ITEM_SKU for product in cart['products'])
 
 
-def add_delivery_to_cart(cart_id, delivery_price):
-    cart = get_cart(cart_id)
+async def place_delivery_order_async(cart_id, customer_location, delivery_price):
+    _, cart = await asyncio.gather(
+        moltin_async.add_flow_entry(CUSTOMER_LOCATION_FLOW_SLUG, customer_location),
+        moltin_async.get_cart(cart_id),
+    )
     if not is_delivery_in_cart(cart):
-        add_cart_custom_item(cart_id, DELIVERY_ITEM_NAME, delivery_price)
+        await moltin_async.add_cart_custom_item(cart_id, DELIVERY_ITEM_NAME, delivery_price)
+        cart = await moltin_async.get_cart(cart_id)
+    return cart
 
 
-def get_cart_items_text(cart):
+def place_delivery_order(cart_id, customer_location, delivery_price):
+    cart = moltin_async.run(place_delivery_order_async(cart_id, customer_location, delivery_price))
+    index_customer_location(customer_location)
+    return cart
+
+
+def get_cart_view(cart):
+    return build_cart_view(json.dumps(cart, sort_keys=True, ensure_ascii=False))
+
+
+@lru_cache(maxsize=CART_VIEW_CACHE_SIZE)
+def build_cart_view(cart_json):
+    cart = json.loads(cart_json)
+    text_rows, prices = [], []
+    delivery_item = None
+    for product in cart['products']:
+        if product['sku'] == DELIVERY_ITEM_SKU:
+            delivery_item = product
+            continue
+        text_rows.append('{0}\n{1}\n{3} шт. по цене {2} за штуку\nИтого {4}'.format(product['name'],
+                                                                                 product['description'],
+                                                                                 product['unit_price_formatted'],
+                                                                                 product['quantity'],
+                                                                                 product['total_price_formatted']))
+        prices.append((f'{product["name"]}, {product["quantity"]} шт.', product['unit_price']))
+
+    if delivery_item:
+        text_rows.append(f'Доставка {delivery_item["total_price_formatted"]}')
+        prices.append((delivery_item['name'], delivery_item['unit_price']))
+
     cart_items_text = None
     if cart['products']:
-        text_rows = [
-            '{0}\n{1}\n{3} шт. по цене {2} за штуку\nИтого {4}'.format(product['name'],
-                                                                       product['description'],
-                                                                       product['unit_price_formatted'],
-                                                                       product['quantity'],
-                                                                       product['total_price_formatted'])
-            for product in cart['products'] if product['name'] != DELIVERY_ITEM_NAME]
-
-        if is_delivery_in_cart(cart):
-            delivery_item = next(item for item in cart['products'] if item['name'] == DELIVERY_ITEM_NAME)
-            text_rows.append(f'Доставка {delivery_item["total_price_formatted"]}')
-
         text_rows.append(f'К оплате: {cart["total_price_formatted"]}')
         cart_items_text = '\n\n'.join(text_rows)
 
-    return cart_items_text
+    return {
+        'text': cart_items_text,
+        'prices': tuple(prices),
+        'has_delivery': delivery_item is not None,
+    }
+
+
+def get_cart_items_text(cart):
+    return get_cart_view(cart)['text']
+
+
+register_collector('geocode_cache', get_geocode_stats)
 
 
 def main():
-    pass
+    parser = argparse.ArgumentParser(description='Управление каталогом пиццерии в Moltin')
+    parser.add_argument('command', choices=['update_menu', 'update_addresses', 'backfill_locations'])
+    args = parser.parse_args()
+
+    if args.command == 'update_menu':
+        update_menu(MENU_FILE)
+    elif args.command == 'update_addresses':
+        update_addresses(ADDRESSES_FILE)
+    elif args.command == 'backfill_locations':
+        rebuild_customer_location_index()
 
 
 if __name__ == '__main__':
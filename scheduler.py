@@ -0,0 +1,147 @@
+import os
+import json
+import logging
+import threading
+import time
+import uuid
+
+from dotenv import load_dotenv
+
+from database import get_database_connection
+from metrics import timed, increment, register_collector
+
+load_dotenv()
+SCHEDULER_BATCH_SIZE = int(os.getenv('SCHEDULER_BATCH_SIZE', 100))
+SCHEDULER_POLL_INTERVAL = float(os.getenv('SCHEDULER_POLL_INTERVAL', 1))
+SCHEDULER_LEASE_SECONDS = int(os.getenv('SCHEDULER_LEASE_SECONDS', 60))
+SCHEDULER_MAX_ATTEMPTS = int(os.getenv('SCHEDULER_MAX_ATTEMPTS', 5))
+SCHEDULER_RETRY_BACKOFF = 30
+
+SCHEDULED_JOBS_KEY = 'scheduler:jobs'
+PROCESSING_JOBS_KEY = 'scheduler:processing'
+JOB_PAYLOADS_KEY = 'scheduler:payloads'
+
+# KEYS[1] - scheduled, KEYS[2] - processing, ARGV[1] - now, ARGV[2] - batch size, ARGV[3] - lease deadline
+CLAIM_SCRIPT = '''
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for _, key in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], key)
+    redis.call('ZADD', KEYS[1], ARGV[1], key)
+end
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, key in ipairs(due) do
+    redis.call('ZREM', KEYS[1], key)
+    redis.call('ZADD', KEYS[2], ARGV[3], key)
+end
+return due
+'''
+
+# KEYS[1] - scheduled, KEYS[2] - processing, KEYS[3] - payloads, ARGV[1] - job key
+ACK_SCRIPT = '''
+redis.call('ZREM', KEYS[2], ARGV[1])
+if not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    redis.call('HDEL', KEYS[3], ARGV[1])
+end
+return 1
+'''
+
+# KEYS[1] - scheduled, KEYS[2] - processing, KEYS[3] - payloads, ARGV[1] - job key, ARGV[2] - job, ARGV[3] - due time
+RETRY_SCRIPT = '''
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+return 1
+'''
+
+_scripts = {}
+
+logger = logging.getLogger('tg_bot')
+
+
+def get_script(name, script):
+    if name not in _scripts:
+        _scripts[name] = get_database_connection().register_script(script)
+    return _scripts[name]
+
+
+def schedule_job(name, delay, key=None, **payload):
+    key = key or str(uuid.uuid4())
+    job = json.dumps({'name': name, 'payload': payload, 'attempts': 0})
+    pipeline = get_database_connection().pipeline()
+    pipeline.hset(JOB_PAYLOADS_KEY, key, job)
+    pipeline.zadd(SCHEDULED_JOBS_KEY, {key: time.time() + delay})
+    pipeline.execute()
+    return key
+
+
+def cancel_job(key):
+    pipeline = get_database_connection().pipeline()
+    pipeline.zrem(SCHEDULED_JOBS_KEY, key)
+    pipeline.hdel(JOB_PAYLOADS_KEY, key)
+    pipeline.execute()
+
+
+def claim_due_jobs():
+    now = time.time()
+    keys = get_script('claim', CLAIM_SCRIPT)(keys=[SCHEDULED_JOBS_KEY, PROCESSING_JOBS_KEY],
+                                              args=[now, SCHEDULER_BATCH_SIZE, now + SCHEDULER_LEASE_SECONDS])
+    if not keys:
+        return []
+    jobs = get_database_connection().hmget(JOB_PAYLOADS_KEY, keys)
+    return [(key.decode(), json.loads(job)) for key, job in zip(keys, jobs) if job]
+
+
+def ack_job(key):
+    get_script('ack', ACK_SCRIPT)(keys=[SCHEDULED_JOBS_KEY, PROCESSING_JOBS_KEY, JOB_PAYLOADS_KEY], args=[key])
+
+
+def retry_job(key, job):
+    job = dict(job, attempts=job['attempts'] + 1)
+    due_time = time.time() + SCHEDULER_RETRY_BACKOFF * 2 ** (job['attempts'] - 1)
+    get_script('retry', RETRY_SCRIPT)(keys=[SCHEDULED_JOBS_KEY, PROCESSING_JOBS_KEY, JOB_PAYLOADS_KEY],
+                                      args=[key, json.dumps(job), due_time])
+
+
+def run_due_jobs(bot, handlers):
+    jobs = claim_due_jobs()
+    for key, job in jobs:
+        try:
+            with timed('scheduled_job', job=job['name']):
+                handlers[job['name']](bot, **job['payload'])
+        except Exception as err:
+            increment('scheduled_job_failures_total', job=job['name'])
+            logger.error(f'Job {key} ({job["name"]}) failed: {err}')
+            if job['attempts'] + 1 < SCHEDULER_MAX_ATTEMPTS:
+                retry_job(key, job)
+                continue
+        ack_job(key)
+    return len(jobs)
+
+
+def run_scheduler(bot, handlers):
+    while True:
+        try:
+            if run_due_jobs(bot, handlers) < SCHEDULER_BATCH_SIZE:
+                time.sleep(SCHEDULER_POLL_INTERVAL)
+        except Exception as err:
+            logger.error(f'Scheduler poll failed: {err}')
+            time.sleep(SCHEDULER_POLL_INTERVAL)
+
+
+def start_scheduler(bot, handlers):
+    thread = threading.Thread(target=run_scheduler, args=(bot, handlers), name='scheduler', daemon=True)
+    thread.start()
+    logger.info(f'Scheduler started for jobs: {", ".join(handlers)}')
+    return thread
+
+
+def get_scheduler_stats():
+    pipeline = get_database_connection().pipeline()
+    pipeline.zcard(SCHEDULED_JOBS_KEY)
+    pipeline.zcard(PROCESSING_JOBS_KEY)
+    pipeline.zcount(SCHEDULED_JOBS_KEY, '-inf', time.time())
+    scheduled, processing, due = pipeline.execute()
+    return {'scheduled': scheduled, 'processing': processing, 'due': due}
+
+
+register_collector('scheduler', get_scheduler_stats)
@@ -0,0 +1,95 @@
+import heapq
+import math
+
+EARTH_RADIUS_KM = 6371.0088
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def to_unit_vector(latitude, longitude):
+    latitude, longitude = math.radians(float(latitude)), math.radians(float(longitude))
+    return (
+        math.cos(latitude) * math.cos(longitude),
+        math.cos(latitude) * math.sin(longitude),
+        math.sin(latitude),
+    )
+
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+
+def geohash_encode(latitude, longitude, precision):
+    latitude_range, longitude_range = [-90.0, 90.0], [-180.0, 180.0]
+    geohash = []
+    bits, bit_count, is_longitude = 0, 0, True
+    while len(geohash) < precision:
+        value, value_range = (float(longitude), longitude_range) if is_longitude else (float(latitude), latitude_range)
+        middle = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= middle:
+            bits |= 1
+            value_range[0] = middle
+        else:
+            value_range[1] = middle
+        is_longitude = not is_longitude
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(GEOHASH_ALPHABET[bits])
+            bits, bit_count = 0, 0
+    return ''.join(geohash)
+
+
+def geohash_cell_size(precision):
+    total_bits = precision * 5
+    longitude_bits = (total_bits + 1) // 2
+    latitude_bits = total_bits // 2
+    return 180 / 2 ** latitude_bits, 360 / 2 ** longitude_bits
+
+
+def _squared_chord(a, b):
+    return (a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2
+
+
+class SpatialIndex:
+    # KD-tree over points projected on the unit sphere: the nearest point by chord length
+    # is the nearest point by great-circle distance, so no haversine is needed during search.
+    def __init__(self, points):
+        nodes = [(to_unit_vector(latitude, longitude), item) for item, latitude, longitude in points]
+        self.size = len(nodes)
+        self._root = self._build(nodes, 0)
+
+    def _build(self, nodes, depth):
+        if not nodes:
+            return None
+        axis = depth % 3
+        nodes.sort(key=lambda node: node[0][axis])
+        median = len(nodes) // 2
+        vector, item = nodes[median]
+        return (vector, item, axis,
+                self._build(nodes[:median], depth + 1),
+                self._build(nodes[median + 1:], depth + 1))
+
+    def nearest(self, latitude, longitude, count=1):
+        target = to_unit_vector(latitude, longitude)
+        heap = []
+        counter = 0
+        stack = [(self._root, 0.0)]
+        while stack:
+            node, bound = stack.pop()
+            if node is None or (len(heap) == count and bound >= -heap[0][0]):
+                continue
+            vector, item, axis, left, right = node
+            squared_chord = _squared_chord(vector, target)
+            counter += 1
+            if len(heap) < count:
+                heapq.heappush(heap, (-squared_chord, counter, item))
+            elif squared_chord < -heap[0][0]:
+                heapq.heapreplace(heap, (-squared_chord, counter, item))
+
+            delta = target[axis] - vector[axis]
+            near, far = (left, right) if delta < 0 else (right, left)
+            stack.append((far, delta ** 2))
+            stack.append((near, 0.0))
+
+        return [(item, chord_to_km(math.sqrt(-squared_chord)))
+                for squared_chord, _, item in sorted(heap, reverse=True)]
@@ -0,0 +1,67 @@
+import logging
+
+from database import get_database_connection
+
+STATE_KEY_PREFIX = 'chat'
+STATE_FIELD = 'state'
+VERSION_FIELD = 'version'
+DEFAULT_STATE = 'START'
+DEFAULT_STATE_TTL = 24 * 60 * 60
+
+STATE_TTLS = {
+    'START': 7 * 24 * 60 * 60,
+    'FINISH': 7 * 24 * 60 * 60,
+    'HANDLE_MENU': 7 * 24 * 60 * 60,
+    'WAITING PAYMENT': 2 * 24 * 60 * 60,
+}
+
+# KEYS[1] - chat hash, ARGV[1] - expected version, ARGV[2] - ttl, ARGV[3] - next state, ARGV[4:] - context pairs
+TRANSITION_SCRIPT = '''
+local version = redis.call('HGET', KEYS[1], 'version') or '0'
+if version ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'state', ARGV[3])
+redis.call('HSET', KEYS[1], 'version', tostring(tonumber(version) + 1))
+for i = 4, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+'''
+
+_transition_script = None
+
+logger = logging.getLogger('redis')
+
+
+def get_state_key(chat_id):
+    return f'{STATE_KEY_PREFIX}:{chat_id}'
+
+
+def get_chat_state(chat_id):
+    chat = get_database_connection().hgetall(get_state_key(chat_id))
+    chat = {field.decode(): value.decode() for field, value in chat.items()}
+    state = chat.pop(STATE_FIELD, DEFAULT_STATE)
+    version = chat.pop(VERSION_FIELD, '0')
+    return state, version, chat
+
+
+def get_chat_context(chat_id):
+    _, _, context = get_chat_state(chat_id)
+    return context
+
+
+def transition_chat_state(chat_id, expected_version, next_state, context=None):
+    global _transition_script
+    if _transition_script is None:
+        _transition_script = get_database_connection().register_script(TRANSITION_SCRIPT)
+
+    args = [expected_version, STATE_TTLS.get(next_state, DEFAULT_STATE_TTL), next_state]
+    for field, value in (context or {}).items():
+        args.extend([field, value])
+
+    transited = _transition_script(keys=[get_state_key(chat_id)], args=args)
+    if not transited:
+        logger.warning(f'Chat {chat_id} state changed concurrently, transition to {next_state} skipped')
+    return bool(transited)
@@ -1,28 +1,42 @@
 from ast import literal_eval as make_tuple
+from functools import partial
 import os
 import logging
 from textwrap import dedent
 
-import redis
 from dotenv import load_dotenv
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
+from telegram.error import BadRequest
 from telegram.ext import Filters, Updater
 from telegram.ext import CallbackQueryHandler, CommandHandler, MessageHandler, PreCheckoutQueryHandler
 
-from moltin import get_products, get_product, get_product_image_url, add_cart_item, get_cart, remove_cart_item
+from chat_dispatcher import ChatDispatcher
+from courier_dispatch import enqueue_courier_order
+from metrics import timed, increment, register_collector, start_metrics_server
+from order_log import log_order_event, CART_ADD, CART_REMOVE, DELIVERY_CHOSEN, PICKUP_CHOSEN, INVOICE_SENT, \
+    PAYMENT_RECEIVED
+from scheduler import schedule_job, start_scheduler
+from webhook import set_webhook, start_webhook_server
+from moltin import get_products, get_product, get_product_image_url, add_cart_item, get_cart, remove_cart_item, \
+    get_catalog_cached
 
-from pizza import get_address_coordinates, get_nearest_pizzeria, get_pizzeria, add_customer_location, \
-    get_cart_items_text, add_delivery_to_cart, get_customer_location, DELIVERY_ITEM_NAME
+from state_store import get_chat_state, get_chat_context, transition_chat_state
+
+from pizza import get_address_coordinates, get_pizzeria, place_delivery_order, \
+    get_cart_items_text, get_cart_view, get_delivery_quote, get_product_photo_file_id, \
+    save_product_photo_file_id, forget_product_photo_file_id
 
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 TELEGRAM_PAYMENT_TOKEN = os.getenv('TELEGRAM_PAYMENT_TOKEN')
 TELEGRAM_PAYMENT_PARAMETER = os.getenv('TELEGRAM_PAYMENT_PARAMETER')
 TELEGRAM_PROXY = os.getenv('TELEGRAM_PROXY')
-
-REDIS_HOST = os.getenv('REDIS_HOST')
-REDIS_PORT = os.getenv('REDIS_PORT')
-REDIS_PASWORD = os.getenv('REDIS_PASWORD')
+TELEGRAM_WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL')
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
 
 REQUEST_KWARGS = {
     'proxy_url': TELEGRAM_PROXY,
@@ -30,50 +44,50 @@ REQUEST_KWARGS = {
 
 PRODUCT_SLICE_OFFSET = 8
 
-DELIVERY_OPTIONS = {
-    0.5: 0,
-    5: 100,
-    20: 300,
-}
-
 MESAGE_AFTER_DELIVERY_OFFSET_TIME = 5
 
 INVOICE_PRICE_MULTIPLIER = 100
 
-_database = None
+DISPATCH_WORKERS = int(os.getenv('DISPATCH_WORKERS', 0))
+DISPATCH_QUEUE_SIZE = int(os.getenv('DISPATCH_QUEUE_SIZE', 100))
+DISPATCH_PUT_TIMEOUT = float(os.getenv('DISPATCH_PUT_TIMEOUT', 5))
+DISPATCH_STATS_INTERVAL = 60
+
+_chat_dispatcher = None
 logger = logging.getLogger('tg_bot')
 
 
-def get_database_connection():
-    global _database
-    if _database is None:
-        database_password = REDIS_PASWORD
-        database_host = REDIS_HOST
-        database_port = REDIS_PORT
-        _database = redis.Redis(host=database_host, port=database_port, password=database_password)
-    return _database
+def build_menu_pages():
+    products = get_products()
+    pages = []
+    for start in range(0, max(len(products), 1), PRODUCT_SLICE_OFFSET):
+        stop = start + PRODUCT_SLICE_OFFSET
+        keyboard = [[[product['name'], product['id']]] for product in products[start:stop]]
+        slice_keys = []
+        if start > 0:
+            slice_keys.append(['⬅ Назад', f'slice_{start - PRODUCT_SLICE_OFFSET},{stop - PRODUCT_SLICE_OFFSET}'])
+        if stop < len(products):
+            slice_keys.append(['Вперед ➡', f'slice_{start + PRODUCT_SLICE_OFFSET},{stop + PRODUCT_SLICE_OFFSET}'])
 
+        keyboard.append(slice_keys)
+        keyboard.append([['🛒 Корзина', 'cart']])
+        pages.append(keyboard)
+    return pages
 
-def send_menu(bot, update, menu_slice=''):
-    products = [product['name'] for product in get_products()]
+
+def get_menu_page(page):
+    pages = get_catalog_cached(f'menu_pages:{PRODUCT_SLICE_OFFSET}', build_menu_pages)
+    keyboard = pages[min(max(page, 0), len(pages) - 1)]
+    return InlineKeyboardMarkup([[InlineKeyboardButton(text, callback_data=callback_data)
+                                  for text, callback_data in row] for row in keyboard])
+
+
+def send_menu(bot, update, context=None, menu_slice=''):
+    page = 0
     if menu_slice:
-        start, stop = map(lambda x: int(x), menu_slice.split(','))
-    else:
-        start, stop = 0, PRODUCT_SLICE_OFFSET
-
-    keyboard = [[InlineKeyboardButton(product['name'], callback_data=product['id'])] for product in
-                get_products()[slice(start, stop)]]
-    slice_keys = []
-    if start > 0:
-        slice_keys.extend([InlineKeyboardButton('⬅ Назад',
-                                                callback_data=f'slice_{start - PRODUCT_SLICE_OFFSET},{stop - PRODUCT_SLICE_OFFSET}')])
-    if stop < len(products):
-        slice_keys.extend([InlineKeyboardButton('Вперед ➡',
-                                                callback_data=f'slice_{start + PRODUCT_SLICE_OFFSET},{stop + PRODUCT_SLICE_OFFSET}')])
-
-    keyboard.append(slice_keys)
-    keyboard.append([InlineKeyboardButton('🛒 Корзина', callback_data='cart')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+        start, _ = menu_slice.split(',')
+        page = int(start) // PRODUCT_SLICE_OFFSET
+    reply_markup = get_menu_page(page)
 
     message = update.message if update.message else update.callback_query.message
     chat_id = message.chat_id
@@ -84,13 +98,13 @@ def send_menu(bot, update, menu_slice=''):
     return 'HANDLE_MENU'
 
 
-def handle_menu(bot, update):
+def handle_menu(bot, update, context):
     query = update.callback_query
     button = query.data
 
     if button.startswith('slice_'):
         _, menu_slice = button.split('_')
-        return send_menu(bot, update, menu_slice)
+        return send_menu(bot, update, menu_slice=menu_slice)
     if button == 'cart':
         return send_cart(bot, update)
     else:
@@ -108,23 +122,37 @@ def send_product_detail(bot, update):
     image_id = product['image_id']
 
     message = f'{name}\nСтоимость {price}\n\n{description}'
-    product_image_url = get_product_image_url(image_id)
 
     keyboard = [[InlineKeyboardButton('Положить в корзину', callback_data=product_id)],
                 [InlineKeyboardButton('Назад', callback_data='menu')]]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    bot.send_photo(
-        chat_id=query.message.chat_id,
-        photo=product_image_url,
-        caption=message,
-        reply_markup=reply_markup)
+    send_product_photo(bot, query.message.chat_id, image_id, message, reply_markup)
 
     bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
     return 'HANDLE_PRODUCT_DETAIL'
 
 
-def handle_product_detail(bot, update):
+def send_product_photo(bot, chat_id, image_id, caption, reply_markup):
+    file_id = get_product_photo_file_id(image_id)
+    if file_id:
+        try:
+            return bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption, reply_markup=reply_markup)
+        except BadRequest as err:
+            logger.warning(f'Cached photo for image {image_id} rejected: {err}')
+            forget_product_photo_file_id(image_id)
+
+    sent_message = bot.send_photo(
+        chat_id=chat_id,
+        photo=get_product_image_url(image_id),
+        caption=caption,
+        reply_markup=reply_markup)
+    if sent_message.photo:
+        save_product_photo_file_id(image_id, sent_message.photo[-1].file_id)
+    return sent_message
+
+
+def handle_product_detail(bot, update, context):
     query = update.callback_query
     button = query.data
     if button == 'menu':
@@ -133,6 +161,7 @@ def handle_product_detail(bot, update):
         chat_id = update.callback_query.message.chat_id
         product_id = button
         add_cart_item(chat_id, product_id)
+        log_order_event(chat_id, CART_ADD, 1, product_id)
         bot.answer_callback_query(query.id, text=f'Пицца добавлена в корзину', show_alert=False)
         return 'HANDLE_PRODUCT_DETAIL'
 
@@ -158,7 +187,7 @@ def send_cart(bot, update):
     return 'HANDLE_CART'
 
 
-def handle_cart(bot, update):
+def handle_cart(bot, update, context):
     query = update.callback_query
     button = query.data
     if button == 'menu':
@@ -169,6 +198,7 @@ def handle_cart(bot, update):
         chat_id = update.callback_query.message.chat_id
         cart_item_id = button
         remove_cart_item(chat_id, cart_item_id)
+        log_order_event(chat_id, CART_REMOVE, 1, cart_item_id)
         bot.answer_callback_query(query.id, text=f'Пица удалена из корзины', show_alert=False)
         return send_cart(bot, update)
 
@@ -180,7 +210,7 @@ def send_location_request(bot, update):
     return 'HANDLE_LOCATION_REQUEST'
 
 
-def handle_location_request(bot, update):
+def handle_location_request(bot, update, context):
     message = update.message
     if message.location:
         user_location = (message.location.longitude, message.location.latitude)
@@ -197,21 +227,14 @@ def handle_location_request(bot, update):
 def send_delivery_options(bot, update, user_location):
     chat_id = update.message.chat_id
 
-    nearest_pizzeria = get_nearest_pizzeria(user_location)
-    pizzeria_id, distance = nearest_pizzeria
+    pizzeria_id, distance, delivery_price = get_delivery_quote(user_location)
     pizzeria_address = get_pizzeria(pizzeria_id)['address']
-    delivery_price = None
     text = None
 
     keyboard = [[InlineKeyboardButton('Самовывоз', callback_data=f'pickup_{pizzeria_id}')],
                 [InlineKeyboardButton('Другой адрес', callback_data='change_address')]
                 ]
 
-    for distance_limit, price in DELIVERY_OPTIONS.items():
-        if distance <= distance_limit:
-            delivery_price = price
-            break
-
     if delivery_price is None:
         text = f'''\
         Простите, но так далеко мы пицу не повезем. Ближайшая пицерия в {round(distance)} км. от вас.
@@ -240,10 +263,10 @@ def send_delivery_options(bot, update, user_location):
     reply_markup = InlineKeyboardMarkup(keyboard)
     bot.send_message(chat_id=chat_id, text=dedent(text), reply_markup=reply_markup)
 
-    return 'HANDLE_DELIVERY_OPTIONS'
+    return 'HANDLE_DELIVERY_OPTIONS', {'pizzeria_id': pizzeria_id}
 
 
-def handle_delivery_options(bot, update):
+def handle_delivery_options(bot, update, context):
     query = update.callback_query
     button = query.data
     chat_id = query.message.chat_id
@@ -253,11 +276,12 @@ def handle_delivery_options(bot, update):
         _, delivery_price, user_location = button.split('_')
         user_location = make_tuple(user_location)
         delivery_price = int(delivery_price)
-        return add_delivery_order(bot, update, delivery_price, user_location)
+        return add_delivery_order(bot, update, delivery_price, user_location, context.get('pizzeria_id'))
 
     elif button.startswith('pickup'):
         _, pizzeria_id = button.split('_')
         pizzeria_address = get_pizzeria(pizzeria_id)['address']
+        log_order_event(chat_id, PICKUP_CHOSEN, ref=pizzeria_id)
         bot.edit_message_text(text=f'Вы можете забрать вашу пицу по адресу {pizzeria_address}\nСпасибо за заказ!',
                               chat_id=chat_id, message_id=message_id)
         return 'FINISH'
@@ -265,7 +289,7 @@ def handle_delivery_options(bot, update):
         return send_location_request(bot, update)
 
 
-def add_delivery_order(bot, update, delivery_price, customer_location):
+def add_delivery_order(bot, update, delivery_price, customer_location, pizzeria_id):
     query = update.callback_query
     chat_id = query.message.chat_id
     message_id = query.message.message_id
@@ -277,10 +301,8 @@ def add_delivery_order(bot, update, delivery_price, customer_location):
         'delivery-price': delivery_price,
         'customer_id': chat_id,
     }
-    add_customer_location(customer_location)
-    add_delivery_to_cart(chat_id, delivery_price)
-
-    cart = get_cart(chat_id)
+    cart = place_delivery_order(chat_id, customer_location, delivery_price)
+    log_order_event(chat_id, DELIVERY_CHOSEN, delivery_price, pizzeria_id)
     cart_text = get_cart_items_text(cart)
 
     customer_text = f'Доставим пицу в течении часа после оплаты.\n\n{cart_text}'
@@ -288,23 +310,10 @@ def add_delivery_order(bot, update, delivery_price, customer_location):
     reply_markup = InlineKeyboardMarkup(keyboard)
     bot.edit_message_text(text=customer_text, chat_id=chat_id, message_id=message_id, reply_markup=reply_markup)
 
-    return 'WAITING PAYMENT'
-
-
-def send_order_to_courier(bot, update):
-    customer_id = update.message.chat_id
-    customer_location = get_customer_location(str(customer_id))
-    pizzeria_id, _ = get_nearest_pizzeria(customer_location)
-    courier_id = get_pizzeria(pizzeria_id)['courier-id']
-    cart = get_cart(customer_id)
-    cart_text = get_cart_items_text(cart)
-    courier_text = f'Заказ {customer_id}\n\n{cart_text}\n\nЗАКАЗ ОПЛАЧЕН'
-    bot.send_message(chat_id=courier_id, text=courier_text)
-    longitude, latitude = customer_location
-    bot.send_location(chat_id=courier_id, latitude=latitude, longitude=longitude)
+    return 'WAITING PAYMENT', {'longitude': longitude, 'latitude': latitude}
 
 
-def handle_payment(bot, update):
+def handle_payment(bot, update, context):
     query = update.callback_query
     button = query.data
     if button == 'payment':
@@ -321,13 +330,12 @@ def send_invoice(bot, update):
     provider_token = TELEGRAM_PAYMENT_TOKEN
     start_parameter = TELEGRAM_PAYMENT_PARAMETER
     currency = 'RUB'
-    prices = [LabeledPrice(f'{pizza["name"]}, {pizza["quantity"]} шт.', pizza['unit_price'] * INVOICE_PRICE_MULTIPLIER)
-              for pizza in cart['products'] if pizza["name"] != DELIVERY_ITEM_NAME]
-    delivery = next(item for item in cart['products'] if item['name'] == DELIVERY_ITEM_NAME)
-    prices.append(LabeledPrice(delivery['name'], delivery['unit_price'] * INVOICE_PRICE_MULTIPLIER))
+    cart_prices = get_cart_view(cart)['prices']
+    prices = [LabeledPrice(label, price * INVOICE_PRICE_MULTIPLIER) for label, price in cart_prices]
 
     bot.sendInvoice(chat_id, title, description, payload,
                     provider_token, start_parameter, currency, prices)
+    log_order_event(chat_id, INVOICE_SENT, sum(price for _, price in cart_prices))
 
     return 'WAITING PAYMENT'
 
@@ -341,20 +349,22 @@ def process_precheckout(bot, update):
         bot.answer_pre_checkout_query(pre_checkout_query_id=query.id, ok=True)
 
 
-def process_successful_payment(bot, update, job_queue):
+def process_successful_payment(bot, update):
     chat_id = update.message.chat_id
-    send_order_to_courier(bot, update)
+    log_order_event(chat_id, PAYMENT_RECEIVED,
+                    update.message.successful_payment.total_amount // INVOICE_PRICE_MULTIPLIER)
+    cart_text = get_cart_items_text(get_cart(chat_id))
+    enqueue_courier_order(chat_id, cart_text, get_chat_context(chat_id))
     update.message.reply_text('Мы получили платеж и начали готовить пиццу. Курьер доставит ваш заказ в течении часа')
-    job_queue.run_once(send_message_after_delivery, MESAGE_AFTER_DELIVERY_OFFSET_TIME, context=chat_id)
+    schedule_job('message_after_delivery', MESAGE_AFTER_DELIVERY_OFFSET_TIME, chat_id=chat_id)
 
 
-def send_message_after_delivery(bot, job):
-    bot.send_message(chat_id=job.context,
+def send_message_after_delivery(bot, chat_id):
+    bot.send_message(chat_id=chat_id,
                      text='Приятного аппетита! *место для рекламы*\n\n*сообщение что делать если пицца не пришла*')
 
 
 def handle_users_reply(bot, update):
-    db = get_database_connection()
     if update.message:
         user_reply = update.message.text
         chat_id = update.message.chat_id
@@ -363,10 +373,9 @@ def handle_users_reply(bot, update):
         chat_id = update.callback_query.message.chat_id
     else:
         return
+    user_state, state_version, state_context = get_chat_state(chat_id)
     if user_reply == '/start':
         user_state = 'START'
-    else:
-        user_state = db.get(chat_id).decode("utf-8")
 
     states_functions = {
         'START': send_menu,
@@ -380,23 +389,71 @@ def handle_users_reply(bot, update):
     }
     state_handler = states_functions[user_state]
     try:
-        next_state = state_handler(bot, update)
-        db.set(chat_id, next_state)
-    except Exception as err:
-        logger.error(err)
+        with timed('state_handler', handler=state_handler.__name__):
+            next_state = state_handler(bot, update, state_context)
+        context = None
+        if isinstance(next_state, tuple):
+            next_state, context = next_state
+        transition_chat_state(chat_id, state_version, next_state, context)
+    except Exception:
+        increment('handle_users_reply_errors_total', handler=state_handler.__name__)
+        logger.exception(f'Handler {state_handler.__name__} failed for chat {chat_id} in state {user_state}')
+
+
+def get_update_chat_id(update):
+    chat = update.effective_chat
+    return chat.id if chat else update.effective_user.id
+
+
+def dispatch_to_chat_worker(callback):
+    def handler(bot, update, **kwargs):
+        _chat_dispatcher.submit(get_update_chat_id(update), partial(callback, **kwargs), bot, update)
+    return handler
+
+
+def log_dispatcher_stats(bot, job):
+    logger.info(f'Chat dispatcher stats: {_chat_dispatcher.get_stats()}')
+
+
+SCHEDULED_JOBS = {
+    'message_after_delivery': send_message_after_delivery,
+}
 
 
 def start_bot():
+    global _chat_dispatcher
+    if TELEGRAM_WEBHOOK_URL and not TELEGRAM_WEBHOOK_SECRET:
+        raise RuntimeError('TELEGRAM_WEBHOOK_SECRET is required when TELEGRAM_WEBHOOK_URL is set')
     updater = Updater(TELEGRAM_TOKEN, request_kwargs=REQUEST_KWARGS)
     dispatcher = updater.dispatcher
-    dispatcher.add_handler(CallbackQueryHandler(handle_users_reply))
-    dispatcher.add_handler(MessageHandler(Filters.text, handle_users_reply))
-    dispatcher.add_handler(MessageHandler(Filters.location, handle_users_reply, edited_updates=True))
-    dispatcher.add_handler(CommandHandler('start', handle_users_reply))
+
+    users_reply_handler = handle_users_reply
+    successful_payment_handler = process_successful_payment
+    if DISPATCH_WORKERS:
+        _chat_dispatcher = ChatDispatcher(DISPATCH_WORKERS, DISPATCH_QUEUE_SIZE, DISPATCH_PUT_TIMEOUT)
+        users_reply_handler = dispatch_to_chat_worker(handle_users_reply)
+        successful_payment_handler = dispatch_to_chat_worker(process_successful_payment)
+        updater.job_queue.run_repeating(log_dispatcher_stats, DISPATCH_STATS_INTERVAL)
+        register_collector('chat_dispatcher', _chat_dispatcher.get_stats)
+
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    start_scheduler(updater.bot, SCHEDULED_JOBS)
+
+    dispatcher.add_handler(CallbackQueryHandler(users_reply_handler))
+    dispatcher.add_handler(MessageHandler(Filters.text, users_reply_handler))
+    dispatcher.add_handler(MessageHandler(Filters.location, users_reply_handler, edited_updates=True))
+    dispatcher.add_handler(CommandHandler('start', users_reply_handler))
     dispatcher.add_handler(PreCheckoutQueryHandler(process_precheckout))
-    dispatcher.add_handler(MessageHandler(Filters.successful_payment, process_successful_payment, pass_job_queue=True))
-    updater.start_polling()
-    logger.info(f'TG bot started')
+    dispatcher.add_handler(MessageHandler(Filters.successful_payment, successful_payment_handler))
+
+    if TELEGRAM_WEBHOOK_URL:
+        set_webhook(TELEGRAM_TOKEN, f'{TELEGRAM_WEBHOOK_URL}{WEBHOOK_PATH}', TELEGRAM_WEBHOOK_SECRET, TELEGRAM_PROXY)
+        logger.info(f'TG bot started in webhook mode')
+        start_webhook_server(updater, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, TELEGRAM_WEBHOOK_SECRET)
+    else:
+        updater.start_polling()
+        logger.info(f'TG bot started')
 
 
 if __name__ == '__main__':
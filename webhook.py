@@ -0,0 +1,72 @@
+import hmac
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from telegram import Update
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+TELEGRAM_API_ENDPOINT = 'https://api.telegram.org'
+
+logger = logging.getLogger('tg_bot')
+
+
+def set_webhook(token, url, secret_token, proxy_url=None):
+    proxies = {'https': proxy_url} if proxy_url else None
+    response = requests.post(f'{TELEGRAM_API_ENDPOINT}/bot{token}/setWebhook', proxies=proxies, json={
+        'url': url,
+        'secret_token': secret_token,
+    })
+    response.raise_for_status()
+    logger.info(f'Webhook set to {url}')
+
+
+def make_webhook_handler(bot, update_queue, url_path, secret_token):
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200 if self.path == '/healthz' else 404)
+            self.end_headers()
+
+        def do_POST(self):
+            if self.path != url_path:
+                self.send_response(404)
+                self.end_headers()
+                return
+            if not hmac.compare_digest(self.headers.get(SECRET_TOKEN_HEADER, ''), secret_token):
+                self.send_response(403)
+                self.end_headers()
+                return
+
+            content_length = int(self.headers.get('Content-Length', 0))
+            try:
+                update = Update.de_json(json.loads(self.rfile.read(content_length)), bot)
+            except (ValueError, KeyError, TypeError, AttributeError) as err:
+                logger.warning(f'Bad webhook payload: {err}')
+                self.send_response(400)
+                self.end_headers()
+                return
+
+            update_queue.put(update)
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return WebhookHandler
+
+
+def start_webhook_server(updater, listen, port, url_path, secret_token):
+    if not secret_token:
+        raise ValueError('Webhook server needs a secret token: without it anyone can post forged updates')
+    dispatcher = updater.dispatcher
+    threading.Thread(target=dispatcher.start, name='dispatcher', daemon=True).start()
+    updater.job_queue.start()
+
+    handler = make_webhook_handler(updater.bot, dispatcher.update_queue, url_path, secret_token)
+    server = ThreadingHTTPServer((listen, port), handler)
+    server.daemon_threads = True
+    logger.info(f'Webhook server listening on {listen}:{port}{url_path}')
+    server.serve_forever()
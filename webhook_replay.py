@@ -0,0 +1,59 @@
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from webhook import SECRET_TOKEN_HEADER
+
+
+def load_updates(updates_file):
+    with open(updates_file, 'r') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def replay(url, secret_token, updates, total, concurrency):
+    session = requests.Session()
+    session.mount(url, requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+    headers = {SECRET_TOKEN_HEADER: secret_token}
+
+    def send(number):
+        update = dict(updates[number % len(updates)], update_id=number)
+        started = time.perf_counter()
+        response = session.post(url, json=update, headers=headers)
+        return response.status_code, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, range(total)))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for _, latency in results)
+    failed = sum(1 for status, _ in results if status != 200)
+    return {
+        'sent': total,
+        'failed': failed,
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(total / elapsed, 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99)] * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Проигрывает записанные апдейты Telegram в webhook бота')
+    parser.add_argument('updates_file', help='файл с апдейтами, по одному JSON в строке')
+    parser.add_argument('--url', default='http://127.0.0.1:8443/telegram')
+    parser.add_argument('--secret', default='')
+    parser.add_argument('--total', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    args = parser.parse_args()
+
+    stats = replay(args.url, args.secret, load_updates(args.updates_file), args.total, args.concurrency)
+    for name, value in stats.items():
+        print(f'{name}\t{value}')
+
+
+if __name__ == '__main__':
+    main()